@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Cost of making a balance change durable: a fully synced users-row commit per change vs. a ledger
+# append with its own fsync vs. ledger group commit under concurrent handlers; plus startup replay time.
+# Usage: python benchmarks/bench_balance_ledger.py
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+EVENTS = 2_000
+CONCURRENT = 100
+REPLAY_EVENTS = 200_000
+USERS = 10_000
+
+
+def row_commit_per_change():
+    bot.db.execute("PRAGMA synchronous=FULL")
+    start = time.perf_counter()
+    for i in range(EVENTS):
+        uid = i % USERS
+        bot.USER_BALANCES[uid] = bot.USER_BALANCES.get(uid, 0) + 1
+        bot.DB_WRITER.execute(bot.write_user_rows, [bot.user_row(uid)])
+    bot.db.execute("PRAGMA synchronous=NORMAL")
+    return time.perf_counter() - start
+
+
+async def ledger_per_change():
+    start = time.perf_counter()
+    for i in range(EVENTS):
+        bot.adjust_balance(i % USERS, 1)
+        await bot.BALANCE_LEDGER.sync()
+    return time.perf_counter() - start
+
+
+async def ledger_group_commit():
+    async def handler(worker):
+        for i in range(worker, EVENTS, CONCURRENT):
+            bot.adjust_balance(i % USERS, 1)
+            await bot.BALANCE_LEDGER.sync()
+
+    fsyncs = 0
+    write = bot.BALANCE_LEDGER.write
+
+    def counting_write(*args):
+        nonlocal fsyncs
+        fsyncs += 1
+        write(*args)
+
+    bot.BALANCE_LEDGER.write = counting_write
+    start = time.perf_counter()
+    await asyncio.gather(*(handler(w) for w in range(CONCURRENT)))
+    elapsed = time.perf_counter() - start
+    bot.BALANCE_LEDGER.write = write
+    return elapsed, fsyncs
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.DB_PATH = os.path.join(tmp, "bench.db")
+        bot.BALANCE_LEDGER = bot.BalanceLedger(os.path.join(tmp, "ledger"))
+        bot.init_db()
+        bot.replay_balance_ledger()
+        for uid in range(USERS):
+            bot.USER_BALANCES[uid] = 0
+        bot.DB_WRITER.execute(bot.write_user_rows, [bot.user_row(uid) for uid in range(USERS)])
+
+        elapsed = row_commit_per_change()
+        print(f"users row commit, synchronous=FULL : {elapsed / EVENTS * 1e6:>8.0f} us/change")
+        elapsed = await ledger_per_change()
+        print(f"ledger, one fsync per change       : {elapsed / EVENTS * 1e6:>8.0f} us/change")
+        elapsed, fsyncs = await ledger_group_commit()
+        print(f"ledger, {CONCURRENT} concurrent handlers    : {elapsed / EVENTS * 1e6:>8.0f} us/change "
+              f"({EVENTS} changes in {fsyncs} fsyncs)")
+
+        for i in range(REPLAY_EVENTS):
+            bot.adjust_balance(i % USERS, 1)
+        await bot.BALANCE_LEDGER.sync()
+        expected = [bot.USER_BALANCES.get(uid, 0) for uid in range(USERS)]
+        bot.BALANCE_LEDGER.close()
+        # Restart without a final snapshot, as after a crash
+        bot.db.close()
+        bot.USER_STORE.clear()
+        bot.DIRTY_USERS.clear()
+        bot.BALANCE_LEDGER = bot.BalanceLedger(os.path.join(tmp, "ledger"))
+        bot.init_db()
+        start = time.perf_counter()
+        replayed = bot.replay_balance_ledger()
+        elapsed = time.perf_counter() - start
+        balances = [bot.USER_BALANCES.get(uid, 0) for uid in range(USERS)]
+        print(f"startup replay of {replayed} changes  : {elapsed:>8.2f} s "
+              f"(balances {'match' if balances == expected else 'DIFFER'})")
+        bot.db.close()
+
+
+if __name__ == "__main__":
+    bot.logger.disabled = True
+    asyncio.run(main())
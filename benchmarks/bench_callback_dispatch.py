@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Cost of finding the handler for a callback query with the full handler set:
+# the previous chain (one regex CallbackQueryHandler / ConversationHandler per flow) vs. build_handlers().
+# Mirrors Application.process_update: handlers are tried in order until check_update() matches.
+# Usage: python benchmarks/bench_callback_dispatch.py
+import datetime
+import os
+import sys
+import timeit
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+from telegram import CallbackQuery, Chat, Message, Update, User
+from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler
+
+CALLS = 20_000
+SAMPLE_DATA = ["buy_1", "menu_main", "stats_product_1", "admin_cancel", "admin_rename_button", "card_payment"]
+
+
+def legacy_handlers():
+    """The handler chain main() used to register: a regex handler or a conversation per flow."""
+    cancel = [CallbackQueryHandler(bot.admin_cancel_handler, pattern="^admin_cancel$"),
+              CommandHandler("cancel", bot.admin_cancel_handler)]
+    handlers = list(bot.build_handlers()[1:9])
+    handlers.insert(2, CallbackQueryHandler(bot.buy_callback, pattern="^buy_"))
+    handlers.append(CallbackQueryHandler(bot.charge_callback, pattern="^charge_"))
+    for data in ["menu_main", "profile_charge", "check_membership", "confirm_membership"]:
+        handlers.append(CallbackQueryHandler(bot.CALLBACK_ROUTES[data], pattern=f"^{data}$"))
+    handlers.append(CommandHandler("panel", bot.panel_handler))
+    for data, entry in bot.ADMIN_CONVERSATION_ENTRIES.items():
+        handlers.append(ConversationHandler(
+            entry_points=[CallbackQueryHandler(entry, pattern=f"^{data}$")], states={}, fallbacks=cancel))
+    for data in ["admin_users_txt", "admin_phone_file", "admin_turn_on_bot", "admin_turn_off_bot", "admin_stats",
+                 "stats_products"]:
+        handlers.append(CallbackQueryHandler(bot.CALLBACK_ROUTES[data], pattern=f"^{data}$"))
+    handlers.append(CallbackQueryHandler(bot.stats_product_details_handler, pattern="^stats_product_"))
+    handlers.append(CallbackQueryHandler(bot.sales_stats_handler, pattern="^sales_stats_"))
+    for data in ["stats_users", "stats_overall", "admin_backup_db"]:
+        handlers.append(CallbackQueryHandler(bot.CALLBACK_ROUTES[data], pattern=f"^{data}$"))
+    handlers.append(CallbackQueryHandler(bot.admin_banned_list_handler, pattern="^admin_banned_list_"))
+    handlers.append(CallbackQueryHandler(bot.admin_cancel_handler, pattern="^admin_cancel$"))
+    for data in ["card_payment", "crypto_payment"]:
+        handlers.append(CallbackQueryHandler(bot.CALLBACK_ROUTES[data], pattern=f"^{data}$"))
+    handlers.append(bot.build_handlers()[-2])  # trx conversation
+    return handlers
+
+
+def make_callback(data):
+    user = User(id=42, first_name="u", is_bot=False)
+    chat = Chat(id=42, type=Chat.PRIVATE)
+    message = Message(message_id=1, date=datetime.datetime.now(datetime.timezone.utc), chat=chat)
+    return Update(update_id=1, callback_query=CallbackQuery(id="1", from_user=user, chat_instance="1",
+                                                            data=data, message=message))
+
+
+def dispatch(handlers, update):
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+    return None
+
+
+def main():
+    warnings.simplefilter("ignore")
+    chains = [("before", legacy_handlers()), ("after", bot.build_handlers())]
+    print(f"{'callback data':<22} | " + " | ".join(f"{name} ({len(h)} handlers) us" for name, h in chains))
+    for data in SAMPLE_DATA:
+        update = make_callback(data)
+        timings = [min(timeit.repeat(lambda: dispatch(h, update), number=CALLS, repeat=3)) / CALLS * 1e6
+                   for _, h in chains]
+        print(f"{data:<22} | " + " | ".join(f"{t:>{len(name) + 20}.2f}" for t, (name, _) in zip(timings, chains)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Memory and speed of the code index (CodeBloomFilter) vs. an exact Python set of the same codes.
+# Usage: python benchmarks/bench_code_index.py
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+CODE_COUNTS = [1_000_000, 2_000_000, 4_000_000]
+PROBES = 200_000
+
+
+def codes(start, count):
+    return (f"SNAPP-{i:010d}" for i in range(start, start + count))
+
+
+def set_memory_mb(count):
+    tracemalloc.start()
+    exact = set(codes(0, count))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del exact
+    return current / 2**20
+
+
+def main():
+    print(f"{'codes':>9} | {'bloom MiB':>9} | {'set MiB':>8} | {'add us/code':>11} | {'check us/code':>13} | {'false pos.':>10}")
+    for count in CODE_COUNTS:
+        index = bot.CodeBloomFilter(count, bot.CODE_INDEX_ERROR_RATE)
+        start = time.perf_counter()
+        for code in codes(0, count):
+            index.add(code)
+        add_us = (time.perf_counter() - start) / count * 1e6
+        start = time.perf_counter()
+        false_positives = sum(1 for code in codes(count, PROBES) if code in index)
+        check_us = (time.perf_counter() - start) / PROBES * 1e6
+        print(f"{count:>9} | {index.memory_bytes() / 2**20:>9.1f} | {set_memory_mb(count):>8.1f} | "
+              f"{add_us:>11.2f} | {check_us:>13.2f} | {false_positives / PROBES:>10.4%}")
+
+
+if __name__ == "__main__":
+    main()
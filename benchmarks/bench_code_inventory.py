@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Python heap used and latency of selling codes as the stored inventory grows.
+# Codes stay in SQLite (read through mmap); only the sold code is materialized per sale.
+# Usage: python benchmarks/bench_code_inventory.py
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+INVENTORY_SIZES = [10_000, 100_000, 1_000_000]
+SALES = 5_000
+PRODUCT = "bench"
+
+
+async def no_progress(*args):
+    pass
+
+
+async def main():
+    print(f"{'codes':>9} | {'heap during sales (KiB)':>23} | {'us/sale':>8} | reissued")
+    for size in INVENTORY_SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            bot.DB_PATH = os.path.join(tmp, "bench.db")
+            bot.init_db()
+            await bot.add_product(PRODUCT, 1)
+            codes_path = os.path.join(tmp, "codes.txt")
+            with open(codes_path, "w", encoding="utf-8") as f:
+                f.writelines(f"SNAPP-{size}-{i:010d}\n" for i in range(size))
+            await bot.import_code_file(PRODUCT, codes_path, no_progress)
+            bot.USER_BALANCES[1] = SALES
+            tracemalloc.start()
+            start = time.perf_counter()
+            sold = [await bot.sell_service_code(1, PRODUCT, 1) for _ in range(SALES)]
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # Reopen the database as after a restart: the next sale must continue after the last one
+            bot.db.close()
+            bot.init_db()
+            bot.USER_BALANCES[1] = 1
+            next_code = await bot.sell_service_code(1, PRODUCT, 1)
+            reissued = len(set(sold)) != len(sold) or next_code in sold
+            print(f"{size:>9} | {peak / 1024:>23.0f} | {elapsed / SALES * 1e6:>8.0f} | {'YES' if reissued else 'no'}")
+            bot.db.close()
+            bot.PRODUCT_PRICES.clear()
+            bot.PRODUCT_IDS.clear()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Throughput of PerUserUpdateProcessor when every handler waits on a slow Telegram/HTTP call,
+# a check that each user's updates still complete in arrival order, and the latency of other users'
+# updates while one user bursts (their queued updates must not hold the concurrency slots).
+# Usage: python benchmarks/bench_concurrent_updates.py
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+from telegram import Chat, Message, Update, User
+
+USERS = 200
+UPDATES_PER_USER = 5
+HANDLER_LATENCY = 0.05                 # Seconds a handler waits, like a get_chat round trip
+CONCURRENCY_LEVELS = [1, 8, 64, 256]
+BURST_UPDATES = 20                     # Updates one user sends back to back
+BURST_OTHER_USERS = 5                  # Users whose single update arrives right after the burst
+BURST_CONCURRENCY = 8
+
+
+def make_update(update_id, user_id):
+    user = User(id=user_id, first_name="u", is_bot=False)
+    message = Message(message_id=update_id, date=datetime.datetime.now(datetime.timezone.utc),
+                      chat=Chat(id=user_id, type=Chat.PRIVATE), from_user=user, text="x")
+    return Update(update_id=update_id, message=message)
+
+
+async def run(concurrency, updates):
+    processor = bot.PerUserUpdateProcessor(concurrency)
+    seen = {}
+
+    async def handler(update):
+        await asyncio.sleep(HANDLER_LATENCY)
+        seen.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    start = time.perf_counter()
+    async with processor:
+        # Application.process_update spawns one task per update in arrival order
+        await asyncio.gather(*(asyncio.create_task(processor.process_update(u, handler(u))) for u in updates))
+    elapsed = time.perf_counter() - start
+    in_order = all(ids == sorted(ids) for ids in seen.values())
+    return elapsed, in_order
+
+
+async def burst(concurrency):
+    """Seconds until the burst user's last update and the other users' updates complete."""
+    processor = bot.PerUserUpdateProcessor(concurrency)
+    updates = [make_update(i, 1) for i in range(BURST_UPDATES)]
+    updates += [make_update(BURST_UPDATES + i, 2 + i) for i in range(BURST_OTHER_USERS)]
+    done = {}
+
+    async def handler(update):
+        await asyncio.sleep(HANDLER_LATENCY)
+        done[update.update_id] = time.perf_counter()
+
+    start = time.perf_counter()
+    async with processor:
+        await asyncio.gather(*(asyncio.create_task(processor.process_update(u, handler(u))) for u in updates))
+    burst_s = done[BURST_UPDATES - 1] - start
+    others_s = max(done[u.update_id] for u in updates[BURST_UPDATES:]) - start
+    return burst_s, others_s
+
+
+async def main():
+    # Interleave users the way a busy drop delivers them
+    updates = [make_update(i * USERS + uid, uid + 1) for i in range(UPDATES_PER_USER) for uid in range(USERS)]
+    print(f"{len(updates)} updates from {USERS} users, {HANDLER_LATENCY * 1000:.0f} ms per handler")
+    print(f"{'concurrency':>11} | {'seconds':>8} | {'updates/s':>9} | per-user order")
+    for concurrency in CONCURRENCY_LEVELS:
+        elapsed, in_order = await run(concurrency, updates)
+        print(f"{concurrency:>11} | {elapsed:>8.2f} | {len(updates) / elapsed:>9.0f} | {'kept' if in_order else 'BROKEN'}")
+    burst_s, others_s = await burst(BURST_CONCURRENCY)
+    print(f"\nburst of {BURST_UPDATES} updates from one user, then {BURST_OTHER_USERS} other users "
+          f"(concurrency {BURST_CONCURRENCY}):")
+    print(f"burst user done after {burst_s:.2f} s, other users done after {others_s:.2f} s "
+          f"({'not blocked' if others_s < 2 * HANDLER_LATENCY else 'BLOCKED'} by the burst)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
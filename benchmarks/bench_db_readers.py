@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Event-loop stalls while admins run heavy queries: the query executed on the loop through the shared
+# connection (before) vs. awaited on DB_READERS (after). A heartbeat task stands in for other users'
+# updates and records how late it wakes up.
+# Usage: python benchmarks/bench_db_readers.py
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+PURCHASES = 500_000
+QUERIES = 20
+HEARTBEAT = 0.001
+BUYERS_SQL = "SELECT user_id, COUNT(*), SUM(price) FROM purchases WHERE product_id = ? GROUP BY user_id"
+
+
+async def heartbeat(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT)
+        lags.append(time.perf_counter() - start - HEARTBEAT)
+
+
+async def measure(query):
+    lags, stop = [], asyncio.Event()
+    beat = asyncio.create_task(heartbeat(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(query() for _ in range(QUERIES)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    lags.sort()
+    return elapsed, lags[len(lags) // 2] * 1000, lags[-1] * 1000
+
+
+async def on_loop():
+    bot.db.execute(BUYERS_SQL, (1,)).fetchall()
+
+
+async def on_readers():
+    await bot.DB_READERS.fetchall(BUYERS_SQL, (1,))
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.DB_PATH = os.path.join(tmp, "bench.db")
+        bot.init_db()
+        ts = datetime.datetime.utcnow().isoformat()
+        with bot.db:
+            bot.db.executemany("INSERT INTO purchases (user_id, product_id, product_name, price, ts) VALUES (?, 1, 'p', 1, ?)",
+                               ((i % 50_000, ts) for i in range(PURCHASES)))
+        print(f"{QUERIES} concurrent buyer-list queries over {PURCHASES} purchases")
+        print(f"{'':<16} | {'total (s)':>9} | {'median loop lag (ms)':>20} | {'max loop lag (ms)':>17}")
+        for name, query in (("on the loop", on_loop), ("DB_READERS", on_readers)):
+            elapsed, median, worst = await measure(query)
+            print(f"{name:<16} | {elapsed:>9.2f} | {median:>20.2f} | {worst:>17.1f}")
+        bot.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
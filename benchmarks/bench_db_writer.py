@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Purchase throughput under concurrent buyers: a commit per write (DbWriter not started) vs. the
+# group-committing DbWriter, with synchronous=NORMAL (the bot's setting) and FULL (an fsync per commit).
+# Usage: python benchmarks/bench_db_writer.py
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+BUYERS = 200
+SALES = 4_000
+PRODUCT = "bench"
+
+
+async def run_sales(batched):
+    if batched:
+        bot.DB_WRITER = bot.DbWriter(bot.DB_WRITE_BATCH_MAX, bot.DB_WRITE_BATCH_WINDOW)
+        bot.DB_WRITER.start()
+
+    async def buyer(uid):
+        for _ in range(SALES // BUYERS):
+            await bot.sell_service_code(uid, PRODUCT, 1)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(buyer(uid) for uid in range(BUYERS)))
+    elapsed = time.perf_counter() - start
+    metrics = bot.DB_WRITER.metrics()
+    await bot.DB_WRITER.close()
+    bot.DB_WRITER = bot.DbWriter(bot.DB_WRITE_BATCH_MAX, bot.DB_WRITE_BATCH_WINDOW)
+    return elapsed, metrics
+
+
+async def main():
+    print(f"{'synchronous':<11} | {'writer':<16} | {'sales/s':>8} | {'avg batch':>9} | {'avg commit ms':>13}")
+    for synchronous in ("NORMAL", "FULL"):
+        for batched in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                bot.DB_PATH = os.path.join(tmp, "bench.db")
+                bot.init_db()
+                bot.db.execute(f"PRAGMA synchronous={synchronous}")
+                await bot.add_product(PRODUCT, 1)
+                bot.insert_product_codes(bot.PRODUCT_IDS[PRODUCT], [f"CODE-{i:08d}" for i in range(SALES)])
+                elapsed, metrics = await run_sales(batched)
+                name = "group commit" if batched else "commit per write"
+                batch = f"{metrics['avg_batch']:>9.1f}" if batched else f"{1:>9.1f}"
+                commit = f"{metrics['avg_commit_ms']:>13.2f}" if batched else f"{'-':>13}"
+                print(f"{synchronous:<11} | {name:<16} | {SALES / elapsed:>8.0f} | {batch} | {commit}")
+                bot.db.close()
+                bot.PRODUCT_PRICES.clear()
+                bot.PRODUCT_IDS.clear()
+
+
+if __name__ == "__main__":
+    bot.logger.disabled = True
+    asyncio.run(main())
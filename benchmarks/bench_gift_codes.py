@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# Time to create single-use gift codes: one committed insert per code, as create_gift_code() in the
+# manual flow does, vs. write_gift_codes() (the bulk flow's write) in one transaction, plus building
+# the document sent to the admin.
+# Usage: python benchmarks/bench_gift_codes.py
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+COUNTS = [1_000, 10_000, 100_000]
+AMOUNT = 10000
+INSERT_ONE = "INSERT OR IGNORE INTO gift_codes (code, amount, usage, total, created_at) VALUES (?, ?, ?, ?, ?)"
+
+
+def one_by_one(count):
+    for _ in range(count):
+        while not bot.DB_WRITER.execute(bot.db.execute, INSERT_ONE, (bot.generate_gift_code(), AMOUNT, 1, 1, "")).rowcount:
+            pass
+
+
+def main():
+    print(f"{'codes':>7} | {'one by one (s)':>14} | {'bulk (s)':>8} | {'export (s)':>10} | unique")
+    for count in COUNTS:
+        with tempfile.TemporaryDirectory() as tmp:
+            bot.DB_PATH = os.path.join(tmp, "bench.db")
+            bot.init_db()
+            start = time.perf_counter()
+            one_by_one(count)
+            before = time.perf_counter() - start
+            start = time.perf_counter()
+            codes = bot.DB_WRITER.execute(bot.write_gift_codes, count, AMOUNT, 1)
+            bulk = time.perf_counter() - start
+            start = time.perf_counter()
+            bot.export_gift_codes(codes)
+            export = time.perf_counter() - start
+            stored = bot.db.execute("SELECT COUNT(DISTINCT code) FROM gift_codes").fetchone()[0]
+            print(f"{count:>7} | {before:>14.2f} | {bulk:>8.2f} | {export:>10.3f} | "
+                  f"{'yes' if stored == 2 * count else 'NO'}")
+            bot.db.close()
+
+
+if __name__ == "__main__":
+    main()
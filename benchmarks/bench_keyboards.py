@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Per-call cost of the keyboard helpers: rebuilt on every call (before) vs. served from KEYBOARD_CACHE (after).
+# Usage: python benchmarks/bench_keyboards.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+PRODUCTS = 12
+CALLS = 20_000
+
+
+def uncached_picker(prefix):
+    # What every product picker did before: one fresh button per product plus the menu row
+    keyboard = [[bot.InlineKeyboardButton(product, callback_data=f"{prefix}{bot.PRODUCT_IDS[product]}")]
+                for product in bot.PRODUCT_PRICES]
+    keyboard.append([bot.InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
+    return bot.InlineKeyboardMarkup(keyboard)
+
+
+def main():
+    for i in range(PRODUCTS):
+        bot.PRODUCT_PRICES[f"product {i}"] = 30000
+    # Ids as load_products() assigns them; callback data carries the product id
+    for product_id, product in enumerate(bot.PRODUCT_PRICES, start=1):
+        bot.PRODUCT_IDS[product] = product_id
+        bot.PRODUCT_NAMES[product_id] = product
+    cases = [
+        ("main menu", bot.get_main_menu_keyboard.__wrapped__, bot.get_main_menu_keyboard),
+        ("admin panel", bot.get_admin_panel_keyboard.__wrapped__, bot.get_admin_panel_keyboard),
+        (f"buy picker ({PRODUCTS} products)", lambda: uncached_picker("buy_"), bot.get_product_purchase_keyboard),
+        (f"stats picker ({PRODUCTS} products)", lambda: uncached_picker("stats_product_"),
+         lambda: bot.get_product_picker_keyboard("stats_product_")),
+    ]
+    print(f"{'keyboard':<28} | {'rebuilt (us)':>12} | {'cached (us)':>11}")
+    for name, rebuild, cached in cases:
+        before = min(timeit.repeat(rebuild, number=CALLS, repeat=3)) / CALLS * 1e6
+        after = min(timeit.repeat(cached, number=CALLS, repeat=3)) / CALLS * 1e6
+        print(f"{name:<28} | {before:>12.2f} | {after:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Startup time and Python heap after startup as the user base grows: every users row loaded into dicts
+# (plus the top-balance heap) before the bot can answer (before) vs. lazy hydration through USER_STORE (after).
+# Also the latency of the first and of a repeated profile lookup after startup.
+# Usage: python benchmarks/bench_startup.py
+import heapq
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+USER_COUNTS = [10_000, 100_000, 1_000_000]
+LOOKUPS = 10_000
+BASE_ID = 5_000_000_000                # Telegram-sized ids
+
+
+def populate(path, count):
+    bot.DB_PATH = path
+    bot.init_db()
+    conn = bot.db
+    with conn:
+        conn.executemany("INSERT INTO users (user_id, balance, charged, purchased, username) VALUES (?, ?, ?, ?, ?)",
+                         ((BASE_ID + i, i % 977 * 1000, i % 977 * 1000, i % 7, f"user{i}") for i in range(count)))
+        conn.executemany("INSERT INTO registered_users (user_id, registered_at) VALUES (?, '2024-01-01T00:00:00')",
+                         ((BASE_ID + i,) for i in range(count)))
+        conn.executemany("INSERT INTO banned_users (user_id) VALUES (?)", ((BASE_ID + i,) for i in range(0, count, 100)))
+        conn.executemany("INSERT INTO inactive_users (user_id, reason, since) VALUES (?, 'blocked', '2024-01-01')",
+                         ((BASE_ID + i,) for i in range(1, count, 50)))
+    conn.close()
+
+
+def startup():
+    bot.init_db()
+    bot.replay_balance_ledger()
+    bot.load_products()
+    bot.migrate_recent_purchases()
+    bot.load_banned_users()
+    bot.load_inactive_users()
+    bot.load_stats()
+    bot.load_gift_codes()
+
+
+def eager_user_load():
+    # The previous load_user_data() and top-balance heap: every users row in plain dicts
+    balances, charged, purchased, usernames = {}, {}, {}, {}
+    for user_id, balance, charge, bought, username in bot.db.execute(
+            "SELECT user_id, balance, charged, purchased, username FROM users"):
+        if username:
+            usernames[user_id] = username
+        balances[user_id] = balance
+        charged[user_id] = charge
+        purchased[user_id] = bought
+    heap = [(-balance, -purchased.get(uid, 0), uid) for uid, balance in balances.items()]
+    heapq.heapify(heap)
+    return balances, charged, purchased, usernames, heap
+
+
+def measure(path, eager):
+    bot.DB_PATH = path
+    tracemalloc.start()
+    start = time.perf_counter()
+    startup()
+    state = eager_user_load() if eager else None
+    elapsed = time.perf_counter() - start
+    heap, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del state
+    return elapsed, heap
+
+
+def lookup_us(count):
+    uids = [BASE_ID + (i * 7919) % count for i in range(LOOKUPS)]
+    start = time.perf_counter()
+    for uid in uids:
+        bot.USER_BALANCES.get(uid, 0)
+    first = (time.perf_counter() - start) / LOOKUPS * 1e6
+    start = time.perf_counter()
+    for uid in uids:
+        bot.USER_BALANCES.get(uid, 0)
+    repeat = (time.perf_counter() - start) / LOOKUPS * 1e6
+    return first, repeat
+
+
+def main():
+    print(f"{'users':>9} | {'eager s':>8} | {'eager MiB':>9} | {'lazy s':>7} | {'lazy MiB':>8} | "
+          f"{'1st lookup us':>13} | {'cached us':>9}")
+    for count in USER_COUNTS:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            bot.BALANCE_LEDGER = bot.BalanceLedger(os.path.join(tmp, "ledger"))
+            populate(path, count)
+            eager_s, eager_heap = measure(path, eager=True)
+            bot.db.close()
+            lazy_s, lazy_heap = measure(path, eager=False)
+            first, repeat = lookup_us(count)
+            print(f"{count:>9} | {eager_s:>8.2f} | {eager_heap / 2**20:>9.1f} | {lazy_s:>7.2f} | "
+                  f"{lazy_heap / 2**20:>8.1f} | {first:>13.1f} | {repeat:>9.2f}")
+            bot.db.close()
+            bot.BALANCE_LEDGER.close()
+            bot.PRODUCT_PRICES.clear()
+            bot.PRODUCT_IDS.clear()
+
+
+if __name__ == "__main__":
+    bot.logger.disabled = True
+    main()
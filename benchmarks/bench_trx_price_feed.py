@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# TrxPriceFeed against a local stub of the Nobitex stats endpoint: cached read latency,
+# single-flight fetches under concurrent readers and fallback to the last good quote.
+# Usage: python benchmarks/bench_trx_price_feed.py
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+STUB_LATENCY = 0.2                     # Seconds the stub takes to answer, like a slow exchange
+READERS = 500
+STUB = {"requests": 0, "fail": False, "price": "12345.0"}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        STUB["requests"] += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(STUB_LATENCY)
+        if STUB["fail"]:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps({"stats": {"trx-irt": {"latest": STUB["price"]}}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+async def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/market/stats"
+    feed = bot.TrxPriceFeed(url, refresh_interval=1, max_age=5, timeout=2)
+    await feed.start()
+    try:
+        start = time.perf_counter()
+        prices = await asyncio.gather(*(feed.get_price() for _ in range(READERS)))
+        print(f"cold: {READERS} concurrent readers -> {STUB['requests']} request(s), "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms, price {prices[0]}")
+
+        start = time.perf_counter()
+        for _ in range(READERS):
+            await feed.get_price()
+        print(f"warm: {(time.perf_counter() - start) / READERS * 1e6:.1f} us per read, "
+              f"{STUB['requests']} request(s) in total")
+
+        STUB["fail"] = True
+        await asyncio.sleep(1.1)
+        print(f"exchange down, quote {feed.age():.1f}s old -> {await feed.get_price()} (last good)")
+        await asyncio.sleep(4)
+        print(f"exchange down, quote {feed.age():.1f}s old -> {await feed.get_price()} (past max_age)")
+    finally:
+        await feed.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    bot.logger.disabled = True
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Write latency of one purchase: old full-table rewrite vs. dirty-set write-back.
+# Usage: python benchmarks/bench_user_persistence.py
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+USER_COUNTS = [1_000, 10_000, 50_000, 100_000]
+ROUNDS = 5
+
+
+RECENT_PURCHASES = [["2024-01-01T00:00:00", "product"]]
+
+
+def full_table_rewrite(count):
+    # The previous save_all_user_data(): one INSERT OR REPLACE per known user,
+    # re-encoding each user's recent_purchases JSON list
+    cursor = bot.db.cursor()
+    for user_id in range(count):
+        cursor.execute(
+            "INSERT OR REPLACE INTO users (user_id, balance, charged, purchased, recent_purchases) VALUES (?, ?, ?, ?, ?)",
+            (user_id, bot.USER_BALANCES.get(user_id, 0), bot.USER_CHARGED.get(user_id, 0),
+             bot.USER_PURCHASED.get(user_id, 0), json.dumps(RECENT_PURCHASES, ensure_ascii=False))
+        )
+    bot.db.commit()
+
+
+def populate(count):
+    bot.USER_STORE.clear()
+    for uid in range(count):
+        bot.USER_BALANCES[uid] = 50000
+        bot.USER_CHARGED[uid] = 50000
+        bot.USER_PURCHASED[uid] = 1
+        bot.mark_user_dirty(uid)
+    rows = bot.collect_dirty_user_rows()
+    bot.DB_WRITER.execute(bot.write_user_rows, rows)
+    bot.USER_STORE.end_write([row[0] for row in rows])
+
+
+def time_ms(fn):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.DB_PATH = os.path.join(tmp, "bench.db")
+        bot.init_db()
+        bot.USER_STORE.capacity = max(USER_COUNTS)  # every user cached, as with the old in-memory dicts
+        print(f"{'users':>8} | {'full rewrite (ms)':>18} | {'dirty write-back (ms)':>22}")
+        for count in USER_COUNTS:
+            populate(count)
+            full = min(time_ms(lambda: full_table_rewrite(count)) for _ in range(ROUNDS))
+            dirty = []
+            for i in range(ROUNDS):
+                bot.USER_BALANCES[i] -= 1000
+                bot.mark_user_dirty(i)
+                start = time.perf_counter()
+                await bot.save_dirty_user_data()
+                dirty.append((time.perf_counter() - start) * 1000)
+            print(f"{count:>8} | {full:>18.2f} | {min(dirty):>22.3f}")
+        bot.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
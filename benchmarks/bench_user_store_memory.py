@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Python heap per cached user at 1M users for each layout of the per-user state:
+# parallel dicts (the layout before the user store), list rows in an LRU dict, __slots__ records,
+# and the columnar UserStore (id -> slot dict plus int64 arrays, CLOCK eviction). Ids and usernames are built
+# beforehand: every layout references the same objects, so only the layout itself is measured.
+# Usage: python benchmarks/bench_user_store_memory.py
+import collections
+import heapq
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import forosh_code_food_k as bot
+
+USERS = 1_000_000
+LOOKUPS = 1_000_000
+BASE_ID = 5_000_000_000                # Telegram-sized ids
+GIFT_USERS_EVERY = 10                  # One user in ten has redeemed a gift code
+
+
+class UserRecord:
+    __slots__ = ("balance", "charged", "purchased", "username")
+
+    def __init__(self, balance, charged, purchased, username):
+        self.balance = balance
+        self.charged = charged
+        self.purchased = purchased
+        self.username = username
+
+
+def values(i):
+    # Fresh int objects per user, as values read from SQLite are
+    return 1000 * (i % 977) + 1000, 5000 * (i % 313) + 5000, i % 7
+
+
+def parallel_dicts(uids, names):
+    balances, charged, purchased, info, gift_usage, last_gift = {}, {}, {}, {}, {}, {}
+    for i, uid in enumerate(uids):
+        balances[uid], charged[uid], purchased[uid] = values(i)
+        if names[i]:
+            info[uid] = names[i]
+        if i % GIFT_USERS_EVERY == 0:
+            gift_usage[uid] = 1
+            last_gift[uid] = "GIFT-CODE"
+    heap = [(-balances[uid], -purchased[uid], uid) for uid in uids]
+    heapq.heapify(heap)
+    return (balances, charged, purchased, info, gift_usage, last_gift, heap), lambda uid: balances.get(uid, 0)
+
+
+def list_rows(uids, names):
+    rows = collections.OrderedDict()
+    for i, uid in enumerate(uids):
+        rows[uid] = [*values(i), names[i]]
+    return rows, lambda uid: rows[uid][0]
+
+
+def slots_records(uids, names):
+    rows = collections.OrderedDict()
+    for i, uid in enumerate(uids):
+        rows[uid] = UserRecord(*values(i), names[i])
+    return rows, lambda uid: rows[uid].balance
+
+
+def columnar_store(uids, names):
+    store = bot.UserStore(USERS)
+    for i, uid in enumerate(uids):
+        store.insert(uid, *values(i), names[i])
+    balances = bot.UserField(store, 0)
+    return store, lambda uid: balances.get(uid, 0)
+
+
+def main():
+    uids = [BASE_ID + i for i in range(USERS)]
+    names = [f"user{i}" if i % 2 else None for i in range(USERS)]
+    probes = [uids[(i * 7919) % USERS] for i in range(LOOKUPS)]
+    layouts = [("parallel dicts + top heap", parallel_dicts), ("list rows (LRU dict)", list_rows),
+               ("__slots__ records (LRU dict)", slots_records), ("columnar UserStore", columnar_store)]
+    print(f"{'layout':<30} | {'MiB':>7} | {'bytes/user':>10} | {'balance lookup ns':>17}")
+    for name, build in layouts:
+        tracemalloc.start()
+        state, get_balance = build(uids, names)
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for uid in probes:
+            get_balance(uid)
+        lookup = (time.perf_counter() - start) / LOOKUPS * 1e9
+        print(f"{name:<30} | {used / 2**20:>7.1f} | {used / USERS:>10.0f} | {lookup:>17.0f}")
+        del state, get_balance
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 import logging
 import asyncio
+import bisect
+import collections
+import concurrent.futures
 import datetime
+import functools
 import os
 import json
 import sqlite3
-import random
 import string
+import threading
+import time
+import weakref
+from array import array
+import heapq
+import hashlib
+import math
 import nest_asyncio
-import requests
+import httpx
 import re
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 import telegram.error
@@ -20,6 +30,7 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    BaseUpdateProcessor,
 )
 
 nest_asyncio.apply()
@@ -40,8 +51,53 @@ ADMIN_ID = 8109736174                  # Admin's numeric ID
 CUSTOM_AMOUNT = 1
 MANDATORY_CHANNEL = "@food_center_Channel"  # First mandatory channel
 MANDATORY_CHANNEL_2 = "@Zerocode_TM"          # Second mandatory channel
+MEMBERSHIP_CACHE_TTL = 600             # Seconds a confirmed membership is trusted
+MEMBERSHIP_NEGATIVE_TTL = 30           # Seconds a "not a member" result is trusted
+MEMBERSHIP_CACHE_MAX = 100000          # Expired entries are pruned once the cache grows past this
+
+# Broadcast engine limits (Telegram allows ~30 msg/s overall and ~1 msg/s per chat)
+BROADCAST_RATE = 25                    # Messages per second across all chats
+BROADCAST_PER_CHAT_INTERVAL = 1.0      # Minimum seconds between two attempts to the same chat
+BROADCAST_CONCURRENCY = 20             # Requests in flight at once
+BROADCAST_BATCH = 200                  # Recipients per persisted progress step
+BROADCAST_MAX_ATTEMPTS = 5             # Attempts per recipient on flood-wait / network errors
+BROADCAST_PROGRESS_INTERVAL = 5        # Seconds between progress message edits
+UPDATE_CONCURRENCY = 64                # Updates handled at once (updates of one user still run in order)
+REGISTRY_COMPACTION_INTERVAL = 6 * 3600  # Seconds between purges of inactive users from the registry
+DB_PATH = "user_data.db"               # SQLite database file
+DB_MMAP_SIZE = 256 * 2**20             # Bytes of the database file SQLite reads through mmap instead of read()
+DB_CACHE_KIB = 8192                    # Per-connection page cache; code inventory size does not change memory use
+DB_WRITE_BATCH_MAX = 256               # Writes committed together at most
+DB_WRITE_BATCH_WINDOW = 0.002          # Seconds the writer waits for more writes before committing a batch
+DB_READER_CONNECTIONS = 4              # Read-only connections (one per reader thread) for queries from handlers
+DB_STATEMENT_CACHE = 256               # Prepared statements kept per connection
+USER_CACHE_SIZE = 50_000               # User rows kept in memory; others are read from the users table on access
+LEGACY_REGISTERED_USERS_PATH = "registered_users.txt"  # Imported once into the registered_users table
+USERS_TXT_PATH = "user.txt"            # Export generated on demand for the admin
+USERS_TXT_CHUNK = 5000                 # Rows fetched per round trip while exporting
+CODE_IMPORT_CHUNK_BYTES = 256 * 1024   # Bytes of a code file read and inserted per step
+CODE_IMPORT_PROGRESS_INTERVAL = 3      # Seconds between progress edits during a code import
+CODE_UPLOAD_DIR = "codes"              # Code files uploaded as Telegram documents are stored here
+CODE_INDEX_MIN_CAPACITY = 1_000_000    # Codes the in-memory code index is sized for at least
+CODE_INDEX_ERROR_RATE = 0.001          # False-positive rate of the code index (positives are checked exactly)
+TRX_PRICE_URL = "https://api.nobitex.ir/market/stats"  # TRX/IRT quote source
+TRX_PRICE_REFRESH_INTERVAL = 30        # Seconds between background quote refreshes
+TRX_PRICE_MAX_AGE = 600                # Older quotes are not shown to users
+TRX_PRICE_TIMEOUT = 10                 # Seconds allowed for one quote request
+STATS_WINDOW_HOURS = 7 * 24            # Hourly buckets kept for the "last 7 days" stats
+STATS_VERIFY_INTERVAL = 3600           # Seconds between checks of the running stats against the database
+STATS_VERIFY_ATTEMPTS = 10             # Tries per check; a try is skipped while writes land during the recompute
+LEDGER_PATH = "balance_ledger"         # Balance ledger segments are LEDGER_PATH.<snapshot seq>
+LEDGER_FLUSH_INTERVAL = 0.2            # Seconds between background group commits of the ledger
+LEDGER_SNAPSHOT_INTERVAL = 300         # Seconds between snapshots; bounds how much ledger is replayed at startup
+GIFT_ATTEMPT_LIMIT = 5                 # Gift code attempts a user may make per window
+GIFT_ATTEMPT_WINDOW = 600              # Seconds of the sliding window for gift code attempts
+GIFT_CODE_LENGTH = 8                   # Characters in a generated gift code
+GIFT_CODE_ALPHABET = string.ascii_uppercase + string.digits
+GIFT_BULK_MAX = 100_000                # Codes one bulk generation may create
 
 # Global modifiable product prices dictionary with an initial product.
+# Seeds the products table on first run; afterwards it mirrors the table.
 PRODUCT_PRICES = {"🍔کد 170/300 اسنپ فود🍕": 30000}
 
 # =====================================================================
@@ -76,6 +132,8 @@ GIFT_CODE_INPUT = 1000
 ADMIN_CREATE_GIFT_AMOUNT = 700
 ADMIN_CREATE_GIFT_USAGE = 701
 ADMIN_GIFT_CHOICE = 702
+ADMIN_BULK_GIFT_COUNT = 703
+ADMIN_BULK_GIFT_AMOUNT = 704
 RANDOM_WINNER_COUNT = 710
 RANDOM_CREDIT_AMOUNT = 711
 
@@ -93,38 +151,252 @@ RENAME_BUTTON_INPUT = 321
 TRX_PAYMENT_MENU = 1500
 TRX_CUSTOM_INPUT = 1501
 
+# =====================================================================
+# User Store (users rows loaded on first access)
+# =====================================================================
+class IdSet:
+    """Set of user ids kept as a sorted array: 8 bytes per id, membership by binary search."""
+
+    def __init__(self, ids=()):
+        self.ids = array("q", sorted(set(ids)))
+
+    def __contains__(self, user_id) -> bool:
+        i = bisect.bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, user_id: int):
+        i = bisect.bisect_left(self.ids, user_id)
+        if i == len(self.ids) or self.ids[i] != user_id:
+            self.ids.insert(i, user_id)
+
+    def discard(self, user_id: int):
+        i = bisect.bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            del self.ids[i]
+
+    def update(self, user_ids):
+        new_ids = sorted({uid for uid in user_ids if uid not in self})
+        if new_ids:
+            self.ids = array("q", heapq.merge(self.ids, new_ids))
+
+    def clear(self):
+        self.ids = array("q")
+
+class UserStore:
+    """Bounded cache of users rows, stored column-wise: one user_id -> slot dict and per-column arrays
+    addressed by slot (balance, charged, purchased, ledger_seq as int64, usernames as a list).
+    A row is read from the users table the first time it is needed, so startup does not load users.
+    Eviction is CLOCK (approximate LRU): a hit only sets the slot's reference byte.
+    Rows of dirty users and of users whose row is being written are pinned: they are never evicted
+    while they may be newer than the database."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.slots = {}                         # user_id -> slot in the columns
+        self.columns = (array("q"), array("q"), array("q"), [], array("q"))
+        self.owners = array("q")                # slot -> user_id, -1 for a free slot
+        self.referenced = bytearray()           # slot -> 1 if used since the clock hand last passed
+        self.hand = 0
+        self.free = []                          # Slots of evicted rows, reused before the columns grow
+        self.writing = collections.Counter()    # user_id -> writes in flight that carry the user's row
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, path: str):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = sqlite3.connect(path, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+        self.conn.execute("PRAGMA query_only=ON")
+        self.conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        self.clear()
+        self.writing.clear()
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def is_pinned(self, user_id: int) -> bool:
+        return user_id in DIRTY_USERS or user_id in self.writing
+
+    def pending(self) -> set:
+        """Users whose cached row may differ from the users table."""
+        return DIRTY_USERS.union(self.writing)
+
+    def evict(self, room: int = 0):
+        """Drop unpinned rows not used since the clock hand last passed until `room` more rows fit."""
+        if len(DIRTY_USERS) + len(self.writing) >= len(self.slots):
+            return
+        owners, referenced = self.owners, self.referenced
+        steps = 2 * len(owners)  # two sweeps: the first may only clear reference bytes
+        while len(self.slots) + room > self.capacity and steps:
+            steps -= 1
+            slot = self.hand
+            self.hand = (slot + 1) % len(owners)
+            user_id = owners[slot]
+            if user_id < 0 or self.is_pinned(user_id):
+                continue
+            if referenced[slot]:
+                referenced[slot] = 0
+                continue
+            del self.slots[user_id]
+            owners[slot] = -1
+            self.columns[3][slot] = None
+            self.free.append(slot)
+
+    def insert(self, user_id: int, balance: int, charged: int, purchased: int, username, ledger_seq: int = 0) -> int:
+        """Cache a row for a user that is not cached yet; returns its slot."""
+        self.evict(room=1)
+        if self.free:
+            slot = self.free.pop()
+            for column, value in zip(self.columns, (balance, charged, purchased, username, ledger_seq)):
+                column[slot] = value
+            self.owners[slot] = user_id
+            self.referenced[slot] = 1
+        else:
+            slot = len(self.owners)
+            for column, value in zip(self.columns, (balance, charged, purchased, username, ledger_seq)):
+                column.append(value)
+            self.owners.append(user_id)
+            self.referenced.append(1)
+        self.slots[user_id] = slot
+        return slot
+
+    def slot(self, user_id: int):
+        """Slot of the user's row, or None if the user has no row yet."""
+        slot = self.slots.get(user_id)
+        if slot is not None:
+            self.hits += 1
+            self.referenced[slot] = 1
+            return slot
+        self.misses += 1
+        found = self.conn.execute(
+            "SELECT balance, charged, purchased, username, ledger_seq FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if found is None:
+            return None
+        balance, charged, purchased, username, ledger_seq = found
+        return self.insert(user_id, balance or 0, charged or 0, purchased or 0, username, ledger_seq)
+
+    def slot_for_update(self, user_id: int) -> int:
+        slot = self.slot(user_id)
+        if slot is None:
+            slot = self.insert(user_id, 0, 0, 0, None)
+        return slot
+
+    def begin_write(self, user_ids):
+        self.writing.update(user_ids)
+
+    def end_write(self, user_ids):
+        self.writing.subtract(user_ids)
+        for user_id in user_ids:
+            if self.writing[user_id] <= 0:
+                del self.writing[user_id]
+
+    def clear(self):
+        """Forget cached rows (dirty ones must have been written)."""
+        self.slots.clear()
+        self.columns = (array("q"), array("q"), array("q"), [], array("q"))
+        self.owners = array("q")
+        self.referenced = bytearray()
+        self.hand = 0
+        self.free.clear()
+
+class UserField:
+    """Dict-like view of one column of the user store; setting a value marks the user dirty."""
+
+    def __init__(self, store: UserStore, index: int):
+        self.store = store
+        self.index = index
+
+    def get(self, user_id: int, default=None):
+        slot = self.store.slot(user_id)
+        return default if slot is None else self.store.columns[self.index][slot]
+
+    def __getitem__(self, user_id: int):
+        slot = self.store.slot(user_id)
+        if slot is None:
+            raise KeyError(user_id)
+        return self.store.columns[self.index][slot]
+
+    def __setitem__(self, user_id: int, value):
+        self.store.columns[self.index][self.store.slot_for_update(user_id)] = value
+        mark_user_dirty(user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.store.slot(user_id) is not None
+
 # =====================================================================
 # Global Dictionaries and Sets for Data Storage
 # =====================================================================
-USER_BALANCES = {}                     # user_id -> current balance
-USER_CHARGED = {}                      # user_id -> total charged amount
-USER_PURCHASED = {}                    # user_id -> total purchased count
-USER_RECENT_PURCHASES = {}             # user_id -> list of tuples (timestamp, product)
-BANNED_USERS = {}                      # user_id -> True if banned (همچنین در دیتابیس ذخیره می‌شود)
-SERVICE_CODES = {}                     # product name -> list of available codes
-SERVICE_FILE_PATH = {}                 # product name -> file path
-REGISTERED_USERS = set()               # Users who started the bot (for broadcast)
+USER_STORE = UserStore(USER_CACHE_SIZE)
+USER_BALANCES = UserField(USER_STORE, 0)  # user_id -> current balance
+USER_CHARGED = UserField(USER_STORE, 1)   # user_id -> total charged amount
+USER_PURCHASED = UserField(USER_STORE, 2) # user_id -> total purchased count
+BANNED_USERS = IdSet()                 # Banned user ids (همچنین در دیتابیس ذخیره می‌شود)
+SERVICE_FILE_PATH = {}                 # product name -> file path (mirrors the products table)
+PRODUCT_IDS = {}                       # product name -> product_id (codes are stored per product_id)
+PRODUCT_NAMES = {}                     # product_id -> product name (callback data carries the id)
+DELETED_PRODUCT_ID = 0                 # service_codes.product_id of sold codes kept after their product was deleted
+PRODUCT_CODE_TOTALS = {}               # product name -> codes stored (sold and unsold), mirrors products.total_codes
+CODE_INDEX = None                      # CodeBloomFilter over every stored code; None until built at startup
+INACTIVE_USERS = IdSet()               # Users who blocked the bot or deleted their account (skipped everywhere)
 BOT_ACTIVE = True                      # Global bot status
-gift_codes = {}                        # Gift codes dictionary
-
-# New globals to track gift code usage per user
-USER_GIFT_USAGE = {}                   # user_id -> number of times gift code redeemed
-USER_LAST_GIFT_CODE = {}               # user_id -> last gift code redeemed
-
-# Global dictionary for storing user info (username)
-USER_INFO = {}                         # user_id -> username
 
-# New global to track charge transactions: list of tuples (timestamp, user_id, amount)
-charge_history = []
+# Gift codes that still have uses left: code -> ids of users who already redeemed it
+# (NO_GIFT_REDEEMERS, shared by every code, until the first redemption).
+# Unknown, exhausted and repeated codes are rejected from here without touching the database.
+GIFT_CODE_REDEEMERS = {}
+NO_GIFT_REDEEMERS = frozenset()
+GIFT_ATTEMPTS = {}                     # user_id -> deque of monotonic times of recent gift code attempts
+GIFT_ATTEMPTS_SWEPT_AT = 0.0           # monotonic time of the last pruning of GIFT_ATTEMPTS
+# os.urandom byte -> code character; bytes past the last full multiple of the alphabet are dropped (no bias)
+GIFT_CODE_BYTE_TABLE = bytes(GIFT_CODE_ALPHABET.encode()[b % len(GIFT_CODE_ALPHABET)] for b in range(256))
+GIFT_CODE_REJECTED_BYTES = bytes(range(256 - 256 % len(GIFT_CODE_ALPHABET), 256))
+
+# Username per user (a column of the user store)
+USER_INFO = UserField(USER_STORE, 3)   # user_id -> username
+USER_LEDGER_SEQ = UserField(USER_STORE, 4)  # user_id -> seq of the last ledger entry in the balance
+
+# Users whose row changed since the last flush (only these are written back)
+DIRTY_USERS = set()
+USERS_DATA_VERSION = 0                 # Bumped on every user change; invalidates the user.txt export
+USERS_TXT_CACHE = {"version": -1, "total_users": 0, "total_balance": 0}
+
+# Prebuilt reply markups (telegram objects are immutable, so one instance serves every message)
+KEYBOARD_CACHE = {}                    # builder name or picker key -> markup; cleared when products change
+
+# Per-user asyncio locks; an entry disappears once no handler holds its lock
+USER_LOCKS = weakref.WeakValueDictionary()
+
+# Channel membership cache: user_id -> (missing channel or None, expiry on the monotonic clock)
+MEMBERSHIP_CACHE = {}
+MEMBERSHIP_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Running stats, updated as sales/charges happen so the stats panel never scans history
+PRODUCT_SALES = {}                     # product_id -> [codes sold, revenue]
+STATS_HOURLY = {}                      # hours since epoch -> [amount charged, largest charge, codes sold]
+STATS_TOTALS = {"active_users": 0, "total_balance": 0, "gift_codes": 0}
 
 # =====================================================================
 # Database Functions using SQLite
 # =====================================================================
 db = None
+# Guards the shared connection: writes may run on a worker thread via asyncio.to_thread
+db_lock = threading.Lock()
 
 def init_db():
     global db
-    db = sqlite3.connect("user_data.db", check_same_thread=False)
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    db.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
     cursor = db.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -135,111 +407,1377 @@ def init_db():
             recent_purchases TEXT
         )
     """)
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(users)")]
+    if "username" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN username TEXT")
+    # Sequence number of the last balance ledger entry the row includes; replay applies only newer entries
+    if "ledger_seq" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN ledger_seq INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_ledger_seq ON users (ledger_seq)")
     # NEW: Create table for banned users
+    # Top-balance list reads the users table in balance order
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance, purchased)")
+    # Empty once the legacy JSON lists are migrated, so the startup check costs nothing
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_recent_purchases ON users (user_id) WHERE recent_purchases IS NOT NULL")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS banned_users (
             user_id INTEGER PRIMARY KEY
         )
     """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS registered_users (
+            user_id INTEGER PRIMARY KEY,
+            registered_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            product_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            price INTEGER NOT NULL,
+            file_path TEXT NOT NULL DEFAULT ''
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS service_codes (
+            code_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            sold INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Codes of deleted products keep DELETED_PRODUCT_ID (sold ones only; unsold ones are dropped).
+    # Next unsold code of a product is the first entry of this index
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_service_codes_available ON service_codes (product_id, sold, code_id)")
+    # A code is stored once across all products, so it can never be loaded twice or sold again
+    deduplicated = False
+    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_service_codes_unique_code'").fetchone():
+        cursor.execute("""
+            DELETE FROM service_codes WHERE code_id NOT IN (
+                SELECT code_id FROM (
+                    SELECT code_id, ROW_NUMBER() OVER (PARTITION BY code ORDER BY sold DESC, code_id) AS n
+                    FROM service_codes
+                ) WHERE n = 1
+            )
+        """)
+        cursor.execute("DROP INDEX IF EXISTS idx_service_codes_code")
+        cursor.execute("CREATE UNIQUE INDEX idx_service_codes_unique_code ON service_codes (code)")
+        deduplicated = True
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(products)")]
+    if "total_codes" not in columns:
+        cursor.execute("ALTER TABLE products ADD COLUMN total_codes INTEGER NOT NULL DEFAULT 0")
+        deduplicated = True
+    if deduplicated:
+        cursor.execute("""
+            UPDATE products SET total_codes = (
+                SELECT COUNT(*) FROM service_codes WHERE service_codes.product_id = products.product_id
+            )
+        """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gift_codes (
+            code TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL,
+            usage INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            created_at TEXT
+        )
+    """)
+    # One row per (code, user): the primary key stops a user from redeeming the same code twice
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS gift_redemptions (
+            code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            PRIMARY KEY (code, user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_gift_redemptions_user_ts ON gift_redemptions (user_id, ts)")
+    # Ledger sequence number the users table is known to include (single row)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS balance_snapshot (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            seq INTEGER NOT NULL,
+            ts TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS charge_history (
+            charge_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_charge_history_ts ON charge_history (ts)")
+    # Append-only sales log; product_name keeps the name shown at sale time
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS purchases (
+            purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER,
+            product_name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            ts TEXT NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_product_ts ON purchases (product_id, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_ts ON purchases (user_id, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_ts ON purchases (ts)")
+    # Users that can no longer be reached (blocked the bot, deactivated, chat not found)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS inactive_users (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            since TEXT
+        )
+    """)
+    # Broadcast jobs; last_user_id is the resume cursor (recipients are processed in user_id order)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            text TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            admin_chat_id INTEGER NOT NULL,
+            progress_message_id INTEGER,
+            last_user_id INTEGER NOT NULL DEFAULT -1,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at TEXT
+        )
+    """)
     db.commit()
+    DB_READERS.open(DB_PATH)
+    USER_STORE.open(DB_PATH)
+    migrate_legacy_files()
 
-def load_user_data():
-    global USER_BALANCES, USER_CHARGED, USER_PURCHASED, USER_RECENT_PURCHASES
-    cursor = db.cursor()
-    cursor.execute("SELECT user_id, balance, charged, purchased, recent_purchases FROM users")
-    rows = cursor.fetchall()
-    for row in rows:
-        user_id, balance, charged, purchased, recent_purchases_text = row
-        USER_BALANCES[user_id] = balance
-        USER_CHARGED[user_id] = charged
-        USER_PURCHASED[user_id] = purchased
+def migrate_legacy_files():
+    """One-shot import of registered_users.txt; the file is renamed so it is never read again."""
+    if not os.path.exists(LEGACY_REGISTERED_USERS_PATH):
+        return
+    now = datetime.datetime.utcnow().isoformat()
+    with open(LEGACY_REGISTERED_USERS_PATH, "r", encoding="utf-8") as f:
+        user_ids = [int(line) for line in (line.strip() for line in f) if line.isdigit()]
+    with db_lock:
+        with db:
+            db.executemany("INSERT OR IGNORE INTO registered_users (user_id, registered_at) VALUES (?, ?)",
+                           ((uid, now) for uid in user_ids))
+            # Registered users get a users row so the user.txt export includes them
+            db.execute("""
+                INSERT OR IGNORE INTO users (user_id, balance, charged, purchased)
+                SELECT user_id, 0, 0, 0 FROM registered_users
+            """)
+    os.replace(LEGACY_REGISTERED_USERS_PATH, LEGACY_REGISTERED_USERS_PATH + ".migrated")
+    logger.info(f"Migrated {len(user_ids)} registered users from {LEGACY_REGISTERED_USERS_PATH}")
+
+def migrate_recent_purchases():
+    """One-shot move of the legacy users.recent_purchases JSON lists into the purchases table.
+    Runs after load_products so product names resolve to product ids."""
+    rows = db.execute(
+        "SELECT user_id, recent_purchases FROM users WHERE recent_purchases IS NOT NULL AND recent_purchases NOT IN ('', '[]')"
+    ).fetchall()
+    if not rows:
+        with db_lock:
+            with db:
+                db.execute("UPDATE users SET recent_purchases = NULL WHERE recent_purchases IS NOT NULL")
+        return
+    purchases = []
+    for user_id, recent_purchases_text in rows:
         try:
-            USER_RECENT_PURCHASES[user_id] = json.loads(recent_purchases_text) if recent_purchases_text else []
+            entries = json.loads(recent_purchases_text)
         except Exception:
-            USER_RECENT_PURCHASES[user_id] = []
+            continue
+        for timestamp, product in entries:
+            purchases.append((user_id, PRODUCT_IDS.get(product), product, PRODUCT_PRICES.get(product, 0), timestamp))
+    with db_lock:
+        with db:
+            db.executemany(
+                "INSERT INTO purchases (user_id, product_id, product_name, price, ts) VALUES (?, ?, ?, ?, ?)",
+                purchases
+            )
+            db.execute("UPDATE users SET recent_purchases = NULL WHERE recent_purchases IS NOT NULL")
+    logger.info(f"Migrated {len(purchases)} purchases of {len(rows)} users into the purchases table")
 
-def save_all_user_data():
-    cursor = db.cursor()
-    for user_id in USER_BALANCES.keys():
-        balance = USER_BALANCES.get(user_id, 0)
-        charged = USER_CHARGED.get(user_id, 0)
-        purchased = USER_PURCHASED.get(user_id, 0)
-        recent_purchases = USER_RECENT_PURCHASES.get(user_id, [])
-        recent_purchases_str = json.dumps(recent_purchases, ensure_ascii=False)
-        cursor.execute(
-            "INSERT OR REPLACE INTO users (user_id, balance, charged, purchased, recent_purchases) VALUES (?, ?, ?, ?, ?)",
-            (user_id, balance, charged, purchased, recent_purchases_str)
-        )
-    db.commit()
+# =====================================================================
+# Database Writer (group commit of small writes)
+# =====================================================================
+class DbWriter:
+    """Single writer task: writes submitted by handlers are collected for up to DB_WRITE_BATCH_WINDOW
+    seconds (or DB_WRITE_BATCH_MAX writes) and committed in one transaction on a worker thread.
+    Each write runs in its own savepoint, so a failing write is rolled back alone and its caller gets
+    the exception. Before start() (scripts, startup) each write commits on its own."""
+
+    def __init__(self, max_batch: int, window: float):
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.task = None
+        self.busy = False
+        self.outstanding = 0               # Submitted writes whose caller has not resumed yet
+        self.completed = 0                 # Submitted writes that have finished (committed or failed)
+        self.batches = 0
+        self.writes = 0
+        self.largest_batch = 0
+        self.commit_seconds = 0.0
+        self.slowest_commit = 0.0
+
+    def commit(self, batch):
+        """Run [(op, args)] in one transaction; returns one result or exception per write."""
+        results = []
+        with db_lock:
+            try:
+                db.execute("BEGIN")
+                for op, args in batch:
+                    db.execute("SAVEPOINT write")
+                    try:
+                        results.append(op(*args))
+                    except Exception as e:
+                        db.execute("ROLLBACK TO write")
+                        results.append(e)
+                    db.execute("RELEASE write")
+                db.commit()
+            except Exception as e:
+                if db.in_transaction:
+                    db.rollback()
+                return [e] * len(batch)
+        return results
+
+    def execute(self, op, *args):
+        """Run one write in its own transaction on the calling thread."""
+        result = self.commit([(op, args)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def submit(self, op, *args):
+        """Run op(*args) inside the next batch and return its result once the batch is committed."""
+        self.outstanding += 1
+        try:
+            if self.task is None:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, self.execute, op, *args)
+            future = asyncio.get_running_loop().create_future()
+            self.queue.append((op, args, future))
+            self.wakeup.set()
+            result = await future
+        finally:
+            self.outstanding -= 1
+            self.completed += 1
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.queue:
+                if len(self.queue) < self.max_batch:
+                    await asyncio.sleep(self.window)
+                batch = [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+                started = time.perf_counter()
+                self.busy = True
+                try:
+                    results = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.commit, [(op, args) for op, args, _ in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+                finally:
+                    self.busy = False
+                elapsed = time.perf_counter() - started
+                self.batches += 1
+                self.writes += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.commit_seconds += elapsed
+                self.slowest_commit = max(self.slowest_commit, elapsed)
+                for (_, _, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        """Commit what is still queued and stop the writer task."""
+        if self.task is None:
+            return
+        while self.queue or self.busy:
+            await asyncio.sleep(self.window)
+        self.task.cancel()
+        self.task = None
+
+    def metrics(self) -> dict:
+        return {
+            "batches": self.batches,
+            "writes": self.writes,
+            "avg_batch": self.writes / self.batches if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "avg_commit_ms": self.commit_seconds / self.batches * 1000 if self.batches else 0.0,
+            "slowest_commit_ms": self.slowest_commit * 1000,
+        }
+
+DB_WRITER = DbWriter(DB_WRITE_BATCH_MAX, DB_WRITE_BATCH_WINDOW)
+
+class DbReaders:
+    """Pool of reader threads, each with its own read-only connection, so queries from handlers
+    never run on the event loop. WAL lets them read while the writer commits; they see committed
+    data only, so a caller that awaited a write reads its result."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.path = None
+        self.executor = None
+        self.local = threading.local()
+
+    def open(self, path: str):
+        """(Re)open the pool for the database file; connections are created lazily per thread."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.path = path
+        self.local = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="db-reader")
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+            conn.execute("PRAGMA query_only=ON")
+            conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB // self.size}")
+            self.local.conn = conn
+        return conn
+
+    async def run(self, fn, *args):
+        """fn(connection, *args) on a reader thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: fn(self.connection(), *args))
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def column(self, sql: str, params=()):
+        """First column of every row."""
+        return [row[0] for row in await self.fetchall(sql, params)]
+
+    async def scalar(self, sql: str, params=()):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else None
+
+DB_READERS = DbReaders(DB_READER_CONNECTIONS)
+
+def mark_user_dirty(user_id: int):
+    global USERS_DATA_VERSION
+    DIRTY_USERS.add(user_id)
+    USERS_DATA_VERSION += 1
+
+def user_row(user_id: int):
+    return (
+        user_id,
+        USER_BALANCES.get(user_id, 0),
+        USER_CHARGED.get(user_id, 0),
+        USER_PURCHASED.get(user_id, 0),
+        USER_INFO.get(user_id),
+        USER_LEDGER_SEQ.get(user_id, 0),
+    )
+
+# A row never replaces one that includes a later ledger entry (a snapshot built before a sale
+# may commit after it)
+WRITE_USER_ROW_SQL = """
+    INSERT INTO users (user_id, balance, charged, purchased, username, ledger_seq) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        balance = excluded.balance, charged = excluded.charged, purchased = excluded.purchased,
+        username = excluded.username, ledger_seq = excluded.ledger_seq
+    WHERE excluded.ledger_seq >= users.ledger_seq
+"""
+
+def collect_dirty_user_rows():
+    """Snapshot the rows of all dirty users and reset the dirty set; the users stay pinned in the
+    user store until end_write(). Must run on the event loop so the snapshot is consistent with the handlers."""
+    rows = [user_row(user_id) for user_id in DIRTY_USERS]
+    USER_STORE.begin_write(DIRTY_USERS)
+    DIRTY_USERS.clear()
+    return rows
+
+def write_user_rows(rows):
+    db.executemany(WRITE_USER_ROW_SQL, rows)
+
+async def save_dirty_user_data():
+    """Persist only the users changed since the last save, committed with the writer's next batch."""
+    rows = collect_dirty_user_rows()
+    if not rows:
+        return
+    try:
+        await DB_WRITER.submit(write_user_rows, rows)
+    except Exception as e:
+        logger.error(f"Error saving user data: {e}")
+        # Re-queue so the next save retries with the latest in-memory values
+        DIRTY_USERS.update(row[0] for row in rows)
+    finally:
+        USER_STORE.end_write([row[0] for row in rows])
+
+# =====================================================================
+# Balance Ledger (append-only, group-committed, replayed on startup)
+# =====================================================================
+class BalanceLedger:
+    """Append-only log of balance changes: one "seq user_id delta balance_after" line per change.
+    Lines are written and fsync'd in batches; concurrent sync() callers share one fsync.
+    Every users row records the seq of the last entry its balance includes (users.ledger_seq), so
+    replay adds only the deltas of newer entries and is idempotent. A snapshot writes the rows of
+    the users changed since the previous one, after which older segments are deleted.
+    A sale reserves its seq before it commits and appends the line once it has, so lines can reach
+    the file out of seq order."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.seq = 0
+        self.durable_seq = 0               # Highest seq on disk (names the first segment)
+        self.appended = 0                  # Lines appended so far
+        self.written = 0                   # Lines on disk
+        self.pending = []
+        self.touched = set()               # Users changed since the last rotate()
+        self.segment = None
+        self.file = None
+        self.flush_lock = asyncio.Lock()
+
+    def segment_path(self, seq: int) -> str:
+        return f"{self.path}.{seq:012d}"
+
+    def segments(self):
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        names = sorted(name for name in os.listdir(directory)
+                       if name.startswith(prefix) and name[len(prefix):].isdigit())
+        return [os.path.join(directory, name) for name in names]
+
+    def read(self):
+        """(seq, user_id, delta, balance_after) for every complete line of every segment."""
+        for segment in self.segments():
+            with open(segment, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if not line.endswith("\n") or len(parts) != 4:
+                        logger.warning(f"Ignoring torn ledger line in {segment}: {line!r}")
+                        continue
+                    yield tuple(map(int, parts))
+
+    def reserve(self) -> int:
+        """A seq for an entry that is appended later (once the write it belongs to has committed)."""
+        self.seq += 1
+        return self.seq
+
+    def append(self, user_id: int, delta: int, balance: int, seq: int = None) -> int:
+        if seq is None:
+            seq = self.reserve()
+        self.pending.append(f"{seq} {user_id} {delta} {balance}\n")
+        self.appended += 1
+        self.touched.add(user_id)
+        return seq
+
+    def write(self, segment: str, lines):
+        if self.file is None or self.file.name != segment:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(segment, "a", encoding="utf-8")
+        self.file.write("".join(lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def sync(self):
+        """Return once every change appended so far is on disk."""
+        target = self.appended
+        async with self.flush_lock:
+            if self.written >= target:
+                return
+            if self.segment is None:
+                self.segment = self.segment_path(self.durable_seq)
+            lines, self.pending = self.pending, []
+            upto, written = self.seq, self.appended
+            try:
+                await asyncio.to_thread(self.write, self.segment, lines)
+            except Exception:
+                self.pending[:0] = lines
+                raise
+            self.durable_seq, self.written = upto, written
+
+    def rotate(self):
+        """Start a new segment; returns the last sequence number and the users changed before it."""
+        touched, self.touched = self.touched, set()
+        self.segment = self.segment_path(self.seq)
+        return self.seq, touched
+
+    def drop_segments_before(self, segment: str):
+        for path in self.segments():
+            if path < segment:
+                os.remove(path)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Error writing balance ledger: {e}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+BALANCE_LEDGER = BalanceLedger(LEDGER_PATH)
+
+def write_snapshot(rows, seq: int):
+    """Write the user rows and the ledger position they include in one fully synced transaction."""
+    with db_lock:
+        db.execute("PRAGMA synchronous=FULL")
+        try:
+            with db:
+                db.executemany(WRITE_USER_ROW_SQL, rows)
+                db.execute("INSERT OR REPLACE INTO balance_snapshot (id, seq, ts) VALUES (1, ?, ?)",
+                           (seq, datetime.datetime.utcnow().isoformat()))
+        finally:
+            db.execute("PRAGMA synchronous=NORMAL")
+
+def snapshot_rows(touched):
+    """Rows of the dirty and touched users; all of them stay pinned until end_write()."""
+    rows = collect_dirty_user_rows()
+    written = {row[0] for row in rows}
+    extra = [user_id for user_id in touched if user_id not in written]
+    rows.extend(user_row(user_id) for user_id in extra)
+    USER_STORE.begin_write(extra)
+    return rows
+
+async def snapshot_balances():
+    """Persist every user changed since the last snapshot and drop the ledger segments it covers."""
+    seq, touched = BALANCE_LEDGER.rotate()
+    rows = snapshot_rows(touched)
+    try:
+        await asyncio.to_thread(write_snapshot, rows, seq)
+    except Exception as e:
+        logger.error(f"Error writing balance snapshot: {e}")
+        DIRTY_USERS.update(row[0] for row in rows)
+        return
+    finally:
+        USER_STORE.end_write([row[0] for row in rows])
+    await asyncio.to_thread(BALANCE_LEDGER.drop_segments_before, BALANCE_LEDGER.segment)
+
+async def balance_snapshot_loop():
+    while True:
+        await asyncio.sleep(LEDGER_SNAPSHOT_INTERVAL)
+        await snapshot_balances()
+
+def replay_balance_ledger() -> int:
+    """Add the deltas of ledger entries newer than each user's stored row (users.ledger_seq) to
+    USER_BALANCES, then snapshot. Runs first at startup; returns the number of changes replayed."""
+    row = db.execute("SELECT seq FROM balance_snapshot WHERE id = 1").fetchone()
+    snapshot_seq = row[0] if row else 0
+    # Rows may include reserved seqs whose line never reached the ledger; new seqs must stay above them
+    stored_seq = db.execute("SELECT COALESCE(MAX(ledger_seq), 0) FROM users").fetchone()[0]
+    last_seq, replayed = max(snapshot_seq, stored_seq), 0
+    row_seqs = {}                              # user_id -> ledger_seq of the stored row
+    for seq, user_id, delta, balance in BALANCE_LEDGER.read():
+        last_seq = max(last_seq, seq)
+        row_seq = row_seqs.get(user_id)
+        if row_seq is None:
+            row_seq = row_seqs[user_id] = USER_LEDGER_SEQ.get(user_id, 0)
+        if seq > row_seq:
+            USER_BALANCES[user_id] = USER_BALANCES.get(user_id, 0) + delta
+            USER_LEDGER_SEQ[user_id] = max(USER_LEDGER_SEQ[user_id], seq)
+            replayed += 1
+    BALANCE_LEDGER.seq = BALANCE_LEDGER.durable_seq = last_seq
+    seq, touched = BALANCE_LEDGER.rotate()
+    rows = snapshot_rows(touched)
+    write_snapshot(rows, seq)
+    USER_STORE.end_write([row[0] for row in rows])
+    BALANCE_LEDGER.drop_segments_before(BALANCE_LEDGER.segment)
+    if replayed:
+        logger.info(f"Replayed {replayed} balance changes from the ledger (snapshot at {snapshot_seq}, ledger at {last_seq})")
+    return replayed
 
 # NEW: Database utility functions for banned users
 def load_banned_users():
     global BANNED_USERS
-    cursor = db.cursor()
-    cursor.execute("SELECT user_id FROM banned_users")
-    rows = cursor.fetchall()
-    for (user_id,) in rows:
-        BANNED_USERS[user_id] = True
+    BANNED_USERS = IdSet(row[0] for row in db.execute("SELECT user_id FROM banned_users"))
 
-def add_banned_user(user_id: int):
-    cursor = db.cursor()
-    cursor.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
-    db.commit()
-    BANNED_USERS[user_id] = True
+async def add_banned_user(user_id: int):
+    BANNED_USERS.add(user_id)
+    await DB_WRITER.submit(db.execute, "INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
 
-def remove_banned_user(user_id: int):
-    cursor = db.cursor()
-    cursor.execute("DELETE FROM banned_users WHERE user_id = ?", (user_id,))
-    db.commit()
-    if user_id in BANNED_USERS:
-        del BANNED_USERS[user_id]
+async def remove_banned_user(user_id: int):
+    BANNED_USERS.discard(user_id)
+    await DB_WRITER.submit(db.execute, "DELETE FROM banned_users WHERE user_id = ?", (user_id,))
 
-def get_banned_users(offset: int, limit: int = 10):
-    cursor = db.cursor()
-    cursor.execute("SELECT user_id FROM banned_users ORDER BY user_id LIMIT ? OFFSET ?", (limit, offset))
-    rows = cursor.fetchall()
-    return [row[0] for row in rows]
+async def get_banned_users(offset: int, limit: int = 10):
+    return await DB_READERS.column("SELECT user_id FROM banned_users ORDER BY user_id LIMIT ? OFFSET ?",
+                                   (limit, offset))
+
+async def count_banned_users():
+    return await DB_READERS.scalar("SELECT COUNT(*) FROM banned_users")
 
-def count_banned_users():
+# Database utility functions for inactive (unreachable) users
+def load_inactive_users():
+    global INACTIVE_USERS
+    INACTIVE_USERS = IdSet(row[0] for row in db.execute("SELECT user_id FROM inactive_users"))
+
+def write_inactive_users(user_ids, reason: str):
+    now = datetime.datetime.utcnow().isoformat()
+    db.executemany(
+        "INSERT OR REPLACE INTO inactive_users (user_id, reason, since) VALUES (?, ?, ?)",
+        [(uid, reason, now) for uid in user_ids]
+    )
+
+def delete_inactive_user(user_id: int):
+    db.execute("DELETE FROM inactive_users WHERE user_id = ?", (user_id,))
+
+# Database utility functions for broadcast jobs
+BROADCAST_JOB_COLUMNS = ("job_id", "kind", "text", "from_chat_id", "message_id", "admin_chat_id",
+                         "progress_message_id", "last_user_id", "sent", "failed", "status")
+
+def create_broadcast_job(kind: str, admin_chat_id: int, progress_message_id: int,
+                         text: str = None, from_chat_id: int = None, message_id: int = None) -> int:
+    with db_lock:
+        cursor = db.cursor()
+        cursor.execute(
+            "INSERT INTO broadcast_jobs (kind, text, from_chat_id, message_id, admin_chat_id, progress_message_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, text, from_chat_id, message_id, admin_chat_id, progress_message_id,
+             datetime.datetime.utcnow().isoformat())
+        )
+        db.commit()
+        return cursor.lastrowid
+
+async def get_broadcast_job(job_id: int):
+    row = await DB_READERS.fetchone(
+        f"SELECT {', '.join(BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs WHERE job_id = ?", (job_id,))
+    return dict(zip(BROADCAST_JOB_COLUMNS, row)) if row else None
+
+async def get_running_broadcast_jobs():
+    return await DB_READERS.column("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")
+
+def update_broadcast_job(job_id: int, last_user_id: int, sent: int, failed: int, status: str = "running"):
+    db.execute(
+        "UPDATE broadcast_jobs SET last_user_id = ?, sent = ?, failed = ?, status = ? WHERE job_id = ?",
+        (last_user_id, sent, failed, status, job_id)
+    )
+
+# =====================================================================
+# Persistence Functions for Registered Users
+# =====================================================================
+async def register_user(uid) -> bool:
+    """Add the user to the registry; returns True if they were not registered before."""
+    if await DB_READERS.fetchone("SELECT 1 FROM registered_users WHERE user_id = ?", (uid,)):
+        return False
+    cursor = await DB_WRITER.submit(db.execute, "INSERT OR IGNORE INTO registered_users (user_id, registered_at) VALUES (?, ?)",
+                                    (uid, datetime.datetime.utcnow().isoformat()))
+    if cursor.rowcount != 1:
+        return False
+    STATS_TOTALS["active_users"] += 1
+    return True
+
+COUNT_ACTIVE_USERS_AFTER_SQL = """
+    SELECT COUNT(*) FROM registered_users
+    WHERE user_id > ? AND user_id NOT IN (SELECT user_id FROM inactive_users)
+"""
+
+async def count_active_users_after(after_user_id: int) -> int:
+    return await DB_READERS.scalar(COUNT_ACTIVE_USERS_AFTER_SQL, (after_user_id,))
+
+async def get_active_users_page(after_user_id: int, limit: int):
+    """Keyset page of active registered users in user_id order."""
+    return await DB_READERS.column("""
+        SELECT user_id FROM registered_users
+        WHERE user_id > ? AND user_id NOT IN (SELECT user_id FROM inactive_users)
+        ORDER BY user_id LIMIT ?
+    """, (after_user_id, limit))
+
+async def sample_active_users(count: int):
+    return await DB_READERS.column("""
+        SELECT user_id FROM registered_users
+        WHERE user_id NOT IN (SELECT user_id FROM inactive_users)
+        ORDER BY RANDOM() LIMIT ?
+    """, (count,))
+
+def purge_inactive_registered_users() -> int:
+    with db_lock:
+        cursor = db.execute("DELETE FROM registered_users WHERE user_id IN (SELECT user_id FROM inactive_users)")
+        db.commit()
+    return cursor.rowcount
+
+# =====================================================================
+# Persistence Functions for Products, Service Codes, Gift Codes and Charges
+# =====================================================================
+def load_products():
     cursor = db.cursor()
-    cursor.execute("SELECT COUNT(*) FROM banned_users")
-    (count,) = cursor.fetchone()
-    return count
+    if cursor.execute("SELECT COUNT(*) FROM products").fetchone()[0] == 0:
+        with db_lock:
+            with db:
+                db.executemany("INSERT INTO products (name, price) VALUES (?, ?)", PRODUCT_PRICES.items())
+    PRODUCT_PRICES.clear()
+    for product_id, name, price, file_path, total_codes in cursor.execute(
+            "SELECT product_id, name, price, file_path, total_codes FROM products ORDER BY product_id"):
+        PRODUCT_PRICES[name] = price
+        SERVICE_FILE_PATH[name] = file_path
+        PRODUCT_IDS[name] = product_id
+        PRODUCT_NAMES[product_id] = name
+        PRODUCT_CODE_TOTALS[name] = total_codes
+    invalidate_keyboards()
+
+def write_product(name: str, price: int):
+    """Create the product (or reset an existing one with the same name) with no codes.
+    Returns (product_id, total_codes)."""
+    product_id = db.execute("""
+        INSERT INTO products (name, price) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET price = excluded.price, file_path = ''
+        RETURNING product_id
+    """, (name, price)).fetchone()[0]
+    db.execute("DELETE FROM service_codes WHERE product_id = ? AND sold = 0", (product_id,))
+    total_codes = db.execute("""
+        UPDATE products SET total_codes = (SELECT COUNT(*) FROM service_codes WHERE product_id = ?)
+        WHERE product_id = ? RETURNING total_codes
+    """, (product_id, product_id)).fetchone()[0]
+    return product_id, total_codes
+
+async def add_product(name: str, price: int):
+    product_id, total_codes = await DB_WRITER.submit(write_product, name, price)
+    PRODUCT_PRICES[name] = price
+    SERVICE_FILE_PATH[name] = ""
+    PRODUCT_IDS[name] = product_id
+    PRODUCT_NAMES[product_id] = name
+    PRODUCT_CODE_TOTALS[name] = total_codes
+    invalidate_keyboards()
+
+async def set_product_price(name: str, price: int):
+    await DB_WRITER.submit(db.execute, "UPDATE products SET price = ? WHERE product_id = ?", (price, PRODUCT_IDS[name]))
+    PRODUCT_PRICES[name] = price
+    invalidate_keyboards()
+
+async def rename_product(name: str, new_name: str):
+    product_id = PRODUCT_IDS[name]
+    await DB_WRITER.submit(db.execute, "UPDATE products SET name = ? WHERE product_id = ?", (new_name, product_id))
+    PRODUCT_PRICES[new_name] = PRODUCT_PRICES.pop(name)
+    SERVICE_FILE_PATH[new_name] = SERVICE_FILE_PATH.pop(name)
+    PRODUCT_IDS[new_name] = PRODUCT_IDS.pop(name)
+    PRODUCT_NAMES[product_id] = new_name
+    PRODUCT_CODE_TOTALS[new_name] = PRODUCT_CODE_TOTALS.pop(name)
+    invalidate_keyboards()
+
+def write_product_deletion(product_id: int):
+    db.execute("DELETE FROM service_codes WHERE product_id = ? AND sold = 0", (product_id,))
+    # Sold codes stay as tombstones, so they can never be loaded and sold again
+    db.execute("UPDATE service_codes SET product_id = ? WHERE product_id = ?", (DELETED_PRODUCT_ID, product_id))
+    db.execute("DELETE FROM products WHERE product_id = ?", (product_id,))
+
+async def delete_product(name: str):
+    product_id = PRODUCT_IDS[name]
+    await DB_WRITER.submit(write_product_deletion, product_id)
+    del PRODUCT_IDS[name]
+    del PRODUCT_NAMES[product_id]
+    del PRODUCT_PRICES[name]
+    del SERVICE_FILE_PATH[name]
+    del PRODUCT_CODE_TOTALS[name]
+    invalidate_keyboards()
+
+def find_stored_codes(codes):
+    """{code: sold} for the given codes that are already stored under any product.
+    Only codes the code index reports as possibly present are looked up."""
+    index = CODE_INDEX
+    candidates = codes if index is None else [code for code in codes if code in index]
+    stored = {}
+    for i in range(0, len(candidates), 500):
+        batch = candidates[i:i + 500]
+        placeholders = ",".join("?" * len(batch))
+        stored.update(db.execute(f"SELECT code, sold FROM service_codes WHERE code IN ({placeholders})", batch))
+    return stored
+
+def insert_product_codes(product_id: int, codes):
+    """Store the codes that are new across all products in one transaction.
+    Returns (added, already stored, already sold). Runs on a worker thread."""
+    codes = list(dict.fromkeys(codes))
+    with db_lock:
+        stored = find_stored_codes(codes)
+        new_codes = [code for code in codes if code not in stored]
+        with db:
+            added = db.executemany("INSERT OR IGNORE INTO service_codes (product_id, code) VALUES (?, ?)",
+                                   ((product_id, code) for code in new_codes)).rowcount
+            db.execute("UPDATE products SET total_codes = total_codes + ? WHERE product_id = ?", (added, product_id))
+        if CODE_INDEX is not None:
+            for code in new_codes:
+                CODE_INDEX.add(code)
+    return added, len(stored), sum(stored.values())
+
+async def set_product_code_file(name: str, file_path: str):
+    await DB_WRITER.submit(db.execute, "UPDATE products SET file_path = ? WHERE product_id = ?",
+                           (file_path, PRODUCT_IDS[name]))
+    SERVICE_FILE_PATH[name] = file_path
+    invalidate_keyboards()
+
+def write_product_codes_cleared(product_id: int) -> int:
+    """Drop the unsold codes of a product and forget its code file; returns the codes removed."""
+    removed = db.execute("DELETE FROM service_codes WHERE product_id = ? AND sold = 0", (product_id,)).rowcount
+    db.execute("UPDATE products SET file_path = '', total_codes = total_codes - ? WHERE product_id = ?",
+               (removed, product_id))
+    return removed
+
+async def clear_product_codes(name: str):
+    removed = await DB_WRITER.submit(write_product_codes_cleared, PRODUCT_IDS[name])
+    SERVICE_FILE_PATH[name] = ""
+    PRODUCT_CODE_TOTALS[name] -= removed
+    invalidate_keyboards()
+
+async def count_available_codes(name: str) -> int:
+    return await DB_READERS.scalar("SELECT COUNT(*) FROM service_codes WHERE product_id = ? AND sold = 0",
+                                   (PRODUCT_IDS[name],))
+
+async def has_available_code(name: str) -> bool:
+    product_id = PRODUCT_IDS.get(name)
+    if product_id is None:
+        return False
+    return await DB_READERS.fetchone("SELECT 1 FROM service_codes WHERE product_id = ? AND sold = 0 LIMIT 1",
+                                     (product_id,)) is not None
+
+def write_sale(product_id: int, name: str, price: int, user_row):
+    """Claim the oldest unsold code of the product, write the buyer's row and record the purchase.
+    Returns the code, or None when out of stock (nothing is written then)."""
+    row = db.execute("""
+        UPDATE service_codes SET sold = 1
+        WHERE code_id = (SELECT code_id FROM service_codes WHERE product_id = ? AND sold = 0 ORDER BY code_id LIMIT 1)
+        RETURNING code
+    """, (product_id,)).fetchone()
+    if row is None:
+        return None
+    db.execute(WRITE_USER_ROW_SQL, user_row)
+    db.execute(
+        "INSERT INTO purchases (user_id, product_id, product_name, price, ts) VALUES (?, ?, ?, ?, ?)",
+        (user_row[0], product_id, name, price, datetime.datetime.utcnow().isoformat())
+    )
+    return row[0]
+
+async def sell_service_code(user_id: int, name: str, price: int):
+    """Sell the oldest unsold code of the product to the user and return it (None when out of stock).
+    Claiming the code, debiting the user's row and recording the purchase commit together
+    (as one savepoint of a writer batch); the in-memory state is updated once that commit is done.
+    The caller must hold the user's lock and have checked the balance."""
+    product_id = PRODUCT_IDS[name]
+    purchased = USER_PURCHASED.get(user_id, 0) + 1
+    # The debited row carries the debit's ledger seq: replay after a crash never undoes a committed sale,
+    # and the debit line (appended after the commit) adds nothing to a row that includes it
+    seq = BALANCE_LEDGER.reserve()
+    row = (user_id, USER_BALANCES.get(user_id, 0) - price, USER_CHARGED.get(user_id, 0), purchased,
+           USER_INFO.get(user_id), seq)
+    # Pinned while the sale is written: re-reading the row from the database mid-sale would debit twice
+    USER_STORE.begin_write([user_id])
+    try:
+        code = await DB_WRITER.submit(write_sale, product_id, name, price, row)
+        if code is None:
+            return None
+        USER_PURCHASED[user_id] = purchased
+        adjust_balance(user_id, -price, seq)  # stays dirty: a concurrent change may not be in the sale's row
+    finally:
+        USER_STORE.end_write([user_id])
+    count_sale(product_id, price)
+    return code
+
+async def get_product_buyers(name: str):
+    """[(user_id, purchase count, amount paid)] for a product."""
+    return await DB_READERS.fetchall(
+        "SELECT user_id, COUNT(*), SUM(price) FROM purchases WHERE product_id = ? GROUP BY user_id",
+        (PRODUCT_IDS.get(name),)
+    )
+
+async def get_user_purchases_since(user_id: int, since: datetime.datetime):
+    return await DB_READERS.column("SELECT product_name FROM purchases WHERE user_id = ? AND ts >= ? ORDER BY ts",
+                                   (user_id, since.isoformat()))
+
+async def get_last_purchase(user_id: int):
+    return await DB_READERS.scalar("SELECT product_name FROM purchases WHERE user_id = ? ORDER BY ts DESC LIMIT 1",
+                                   (user_id,))
+
+async def create_gift_code(code: str, amount: int, usage: int) -> bool:
+    cursor = await DB_WRITER.submit(
+        db.execute,
+        "INSERT OR IGNORE INTO gift_codes (code, amount, usage, total, created_at) VALUES (?, ?, ?, ?, ?)",
+        (code, amount, usage, usage, datetime.datetime.utcnow().isoformat())
+    )
+    if cursor.rowcount != 1:
+        return False
+    STATS_TOTALS["gift_codes"] += 1
+    if usage > 0:
+        GIFT_CODE_REDEEMERS[code] = NO_GIFT_REDEEMERS
+    return True
+
+def generate_gift_codes(count: int):
+    """count random codes drawn from os.urandom, so codes cannot be predicted from earlier ones."""
+    needed = count * GIFT_CODE_LENGTH
+    chars = b""
+    while len(chars) < needed:
+        missing = needed - len(chars)
+        chars += os.urandom(missing + missing // 16 + 16).translate(GIFT_CODE_BYTE_TABLE, GIFT_CODE_REJECTED_BYTES)
+    chars = chars.decode("ascii")
+    return [chars[i:i + GIFT_CODE_LENGTH] for i in range(0, needed, GIFT_CODE_LENGTH)]
+
+def generate_gift_code() -> str:
+    return generate_gift_codes(1)[0]
+
+def write_gift_codes(count: int, amount: int, usage: int):
+    """Insert count new codes and return them.
+    Candidates already in gift_codes are found with batched lookups and replaced before inserting,
+    so the insert never collides."""
+    codes = []
+    created_at = datetime.datetime.utcnow().isoformat()
+    while len(codes) < count:
+        candidates = list(set(generate_gift_codes(count - len(codes))) - set(codes))
+        existing = set()
+        for i in range(0, len(candidates), 500):
+            batch = candidates[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            existing.update(row[0] for row in db.execute(
+                f"SELECT code FROM gift_codes WHERE code IN ({placeholders})", batch))
+        codes.extend(code for code in candidates if code not in existing)
+    db.executemany("INSERT INTO gift_codes (code, amount, usage, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                   ((code, amount, usage, usage, created_at) for code in codes))
+    return codes
+
+async def create_gift_codes(count: int, amount: int, usage: int = 1):
+    """Create count new codes in one write and return them."""
+    codes = await DB_WRITER.submit(write_gift_codes, count, amount, usage)
+    STATS_TOTALS["gift_codes"] += len(codes)
+    if usage > 0:
+        GIFT_CODE_REDEEMERS.update(dict.fromkeys(codes, NO_GIFT_REDEEMERS))
+    return codes
+
+def export_gift_codes(codes) -> bytes:
+    """The codes one per line, as the contents of the document sent to the admin.
+    Kept in memory only: live codes are never left on disk."""
+    return ("\n".join(codes) + "\n").encode("utf-8")
+
+def load_gift_codes():
+    """Load the live gift codes with their redeemers."""
+    GIFT_CODE_REDEEMERS.clear()
+    for (code,) in db.execute("SELECT code FROM gift_codes WHERE usage > 0"):
+        GIFT_CODE_REDEEMERS[code] = NO_GIFT_REDEEMERS
+    for code, user_id in db.execute("""
+            SELECT r.code, r.user_id FROM gift_redemptions AS r JOIN gift_codes AS g ON g.code = r.code
+            WHERE g.usage > 0
+    """):
+        add_gift_redeemer(code, user_id)
+
+def add_gift_redeemer(code: str, user_id: int):
+    redeemers = GIFT_CODE_REDEEMERS.get(code)
+    if redeemers is NO_GIFT_REDEEMERS:
+        GIFT_CODE_REDEEMERS[code] = {user_id}
+    elif redeemers is not None:
+        redeemers.add(user_id)
+
+async def get_gift_usage(user_id: int):
+    """(codes redeemed, last code redeemed or None) for the user."""
+    count, last_code = await DB_READERS.fetchone("""
+        SELECT COUNT(*), (SELECT code FROM gift_redemptions WHERE user_id = ? ORDER BY ts DESC LIMIT 1)
+        FROM gift_redemptions WHERE user_id = ?
+    """, (user_id, user_id))
+    return count, last_code
+
+def allow_gift_attempt(user_id: int) -> bool:
+    """Sliding-window limit on gift code attempts; records the attempt when it is allowed."""
+    global GIFT_ATTEMPTS_SWEPT_AT
+    now = time.monotonic()
+    if now - GIFT_ATTEMPTS_SWEPT_AT >= GIFT_ATTEMPT_WINDOW:
+        # Forget users whose attempts have all left the window (at most one sweep per window)
+        GIFT_ATTEMPTS_SWEPT_AT = now
+        for uid in [uid for uid, times in GIFT_ATTEMPTS.items() if times[-1] <= now - GIFT_ATTEMPT_WINDOW]:
+            del GIFT_ATTEMPTS[uid]
+    attempts = GIFT_ATTEMPTS.get(user_id)
+    if attempts is None:
+        attempts = GIFT_ATTEMPTS[user_id] = collections.deque()
+    while attempts and attempts[0] <= now - GIFT_ATTEMPT_WINDOW:
+        attempts.popleft()
+    if len(attempts) >= GIFT_ATTEMPT_LIMIT:
+        return False
+    attempts.append(now)
+    return True
+
+def write_redemption(code: str, user_row):
+    """Consume one use of the code for the user and write their row credited with its amount;
+    returns (amount, usage_left, total), "redeemed" if the user already used the code, or None if it
+    is exhausted (nothing is written then). user_row is the row before the credit."""
+    user_id = user_row[0]
+    row = db.execute("""
+        UPDATE gift_codes SET usage = usage - 1
+        WHERE code = ? AND usage > 0
+          AND NOT EXISTS (SELECT 1 FROM gift_redemptions WHERE code = ? AND user_id = ?)
+        RETURNING amount, usage, total
+    """, (code, code, user_id)).fetchone()
+    if row is None:
+        if db.execute("SELECT 1 FROM gift_redemptions WHERE code = ? AND user_id = ?", (code, user_id)).fetchone():
+            return "redeemed"
+        return None
+    db.execute("INSERT INTO gift_redemptions (code, user_id, ts) VALUES (?, ?, ?)",
+               (code, user_id, datetime.datetime.utcnow().isoformat()))
+    db.execute(WRITE_USER_ROW_SQL, (user_id, user_row[1] + row[0], *user_row[2:]))
+    return row
+
+async def redeem_gift_code(code: str, user_id: int):
+    """Consume one use of the code and credit its amount to the user in one transaction.
+    Returns (amount, usage_left, total), "redeemed" if the user already used the code, or None if it is
+    unknown or exhausted. Rejections are decided in memory, so failed guesses never reach the database.
+    The caller must hold the user's lock."""
+    redeemers = GIFT_CODE_REDEEMERS.get(code)
+    if redeemers is None:
+        return None
+    if user_id in redeemers:
+        return "redeemed"
+    # As in sell_service_code: the credited row carries the credit's ledger seq
+    seq = BALANCE_LEDGER.reserve()
+    user_row = (user_id, USER_BALANCES.get(user_id, 0), USER_CHARGED.get(user_id, 0), USER_PURCHASED.get(user_id, 0),
+                USER_INFO.get(user_id), seq)
+    USER_STORE.begin_write([user_id])
+    try:
+        row = await DB_WRITER.submit(write_redemption, code, user_row)
+        if row is not None and row != "redeemed":
+            adjust_balance(user_id, row[0], seq)
+    finally:
+        USER_STORE.end_write([user_id])
+    if row is None:
+        GIFT_CODE_REDEEMERS.pop(code, None)
+    elif row == "redeemed" or row[1] > 0:
+        add_gift_redeemer(code, user_id)
+    else:
+        GIFT_CODE_REDEEMERS.pop(code, None)
+    return row
+
+async def record_charge(user_id: int, amount: int):
+    count_charge(amount)
+    await DB_WRITER.submit(db.execute, "INSERT INTO charge_history (ts, user_id, amount) VALUES (?, ?, ?)",
+                           (datetime.datetime.utcnow().isoformat(), user_id, amount))
+
+def backup_database(dest_path: str):
+    """Consistent copy of the database including pages still in the WAL."""
+    dest = sqlite3.connect(dest_path)
+    try:
+        with db_lock:
+            db.backup(dest)
+    finally:
+        dest.close()
 
 # =====================================================================
-# Persistence Functions for Registered Users and User TXT file
+# NEW: Code Index (Bloom filter over every stored code)
 # =====================================================================
-def load_registered_users():
-    global REGISTERED_USERS
-    if os.path.exists("registered_users.txt"):
-        with open("registered_users.txt", "r", encoding="utf-8") as f:
-            for line in f:
-                uid_line = line.strip()
-                if uid_line:
-                    try:
-                        uid = int(uid_line)
-                        REGISTERED_USERS.add(uid)
-                    except ValueError:
-                        continue
+class CodeBloomFilter:
+    """Bloom filter over code strings: "not in" is certain, "in" may be a false positive
+    (at about error_rate while no more than capacity codes were added)."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, code: str):
+        digest = hashlib.blake2b(code.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, code: str):
+        for position in self._positions(code):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, code: str) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(code))
+
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+def build_code_index() -> CodeBloomFilter:
+    """Index every stored code, read through a separate connection. Runs on a worker thread."""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        count = conn.execute("SELECT COUNT(*) FROM service_codes").fetchone()[0]
+        index = CodeBloomFilter(max(CODE_INDEX_MIN_CAPACITY, 2 * count), CODE_INDEX_ERROR_RATE)
+        cursor = conn.execute("SELECT code FROM service_codes")
+        while True:
+            rows = cursor.fetchmany(USERS_TXT_CHUNK)
+            if not rows:
+                break
+            for (code,) in rows:
+                index.add(code)
+    finally:
+        conn.close()
+    return index
+
+async def load_code_index():
+    """(Re)build the code index; until it is ready imports look every code up in the database."""
+    global CODE_INDEX
+    try:
+        index = await asyncio.to_thread(build_code_index)
+    except Exception as e:
+        logger.error(f"Error building code index: {e}")
+        return
+    with db_lock:
+        CODE_INDEX = index
+    logger.info(f"Code index ready: {index.count} codes, {index.memory_bytes() // 1024} KiB")
 
-def save_registered_user(uid):
-    if uid not in REGISTERED_USERS:
-        with open("registered_users.txt", "a", encoding="utf-8") as f:
-            f.write(str(uid) + "\n")
-        REGISTERED_USERS.add(uid)
+# =====================================================================
+# NEW: Running Stats (per-product sales, hourly buckets, top balances)
+# =====================================================================
+def current_stats_hour() -> int:
+    return int(time.time() // 3600)
+
+def stats_bucket(hour: int):
+    bucket = STATS_HOURLY.get(hour)
+    if bucket is None:
+        bucket = STATS_HOURLY[hour] = [0, 0, 0]
+        oldest = hour - STATS_WINDOW_HOURS
+        for old_hour in [h for h in STATS_HOURLY if h <= oldest]:
+            del STATS_HOURLY[old_hour]
+    return bucket
+
+def count_sale(product_id: int, price: int):
+    sales = PRODUCT_SALES.setdefault(product_id, [0, 0])
+    sales[0] += 1
+    sales[1] += price
+    stats_bucket(current_stats_hour())[2] += 1
+
+def count_charge(amount: int):
+    bucket = stats_bucket(current_stats_hour())
+    bucket[0] += amount
+    bucket[1] = max(bucket[1], amount)
+
+def get_window_stats():
+    """(amount charged, largest charge, codes sold) over the last STATS_WINDOW_HOURS, at hour granularity."""
+    oldest = current_stats_hour() - STATS_WINDOW_HOURS
+    charged = max_charge = sold = 0
+    for hour, (hour_charged, hour_max, hour_sold) in STATS_HOURLY.items():
+        if hour > oldest:
+            charged += hour_charged
+            max_charge = max(max_charge, hour_max)
+            sold += hour_sold
+    return charged, max_charge, sold
+
+def get_product_sales(name: str):
+    """(codes sold, revenue) of a product."""
+    sold, revenue = PRODUCT_SALES.get(PRODUCT_IDS.get(name), (0, 0))
+    return sold, revenue
+
+def adjust_balance(user_id: int, delta: int, seq: int = None) -> int:
+    """Change a user's balance, keeping the running totals in step; returns the new balance.
+    seq is the ledger seq reserved for the change, if its users row was already written with it.
+    The caller holds the user's lock, so no change lands between a sale's reserved seq and its commit."""
+    balance = USER_BALANCES.get(user_id, 0) + delta
+    USER_BALANCES[user_id] = balance
+    seq = BALANCE_LEDGER.append(user_id, delta, balance, seq)
+    USER_LEDGER_SEQ[user_id] = max(USER_LEDGER_SEQ.get(user_id, 0), seq)
+    if user_id not in INACTIVE_USERS:
+        STATS_TOTALS["total_balance"] += delta
+    return balance
+
+async def get_top_balances(limit: int):
+    """Top active users as (uid, balance, purchased), ordered by balance then purchases.
+    Read from the users table in index order; rows pending in the user store replace their stale copies."""
+    pending = USER_STORE.pending()
+    rows = await DB_READERS.fetchall("""
+        SELECT user_id, balance, purchased FROM users
+        WHERE user_id NOT IN (SELECT user_id FROM inactive_users)
+        ORDER BY balance DESC, purchased DESC, user_id LIMIT ?
+    """, (limit + len(pending),))
+    pending = USER_STORE.pending()
+    candidates = {uid: (balance or 0, purchased or 0) for uid, balance, purchased in rows if uid not in pending}
+    for uid in pending:
+        if uid not in INACTIVE_USERS:
+            candidates[uid] = (USER_BALANCES.get(uid, 0), USER_PURCHASED.get(uid, 0))
+    top = sorted(((uid, balance, purchased) for uid, (balance, purchased) in candidates.items()
+                  if uid not in INACTIVE_USERS),
+                 key=lambda user: (-user[1], -user[2], user[0]))
+    return top[:limit]
+
+def stored_active_balance(conn, pending) -> int:
+    """Total balance of active users in the users table, leaving out the pending users
+    (their stored rows may be older than the user store)."""
+    total = conn.execute(
+        "SELECT COALESCE(SUM(balance), 0) FROM users WHERE user_id NOT IN (SELECT user_id FROM inactive_users)"
+    ).fetchone()[0]
+    pending = list(pending)
+    for i in range(0, len(pending), 500):
+        batch = pending[i:i + 500]
+        placeholders = ",".join("?" * len(batch))
+        for balance, inactive in conn.execute(f"""
+                SELECT balance, user_id IN (SELECT user_id FROM inactive_users) FROM users
+                WHERE user_id IN ({placeholders})
+        """, batch):
+            if not inactive:
+                total -= balance or 0
+    return total
+
+def pending_active_balance(pending) -> int:
+    """In-memory balance of the active users among the pending ones."""
+    return sum(USER_BALANCES.get(uid, 0) for uid in pending if uid not in INACTIVE_USERS)
+
+def recompute_stats(conn, pending):
+    """Rebuild every running stat from the database in one read transaction. total_balance leaves out
+    the pending users; the caller adds pending_active_balance() on the event loop."""
+    conn.execute("BEGIN")
+    try:
+        product_sales = {
+            product_id: [sold, revenue]
+            for product_id, sold, revenue in conn.execute(
+                "SELECT product_id, COUNT(*), SUM(price) FROM purchases GROUP BY product_id")
+        }
+        oldest = current_stats_hour() - STATS_WINDOW_HOURS
+        since = datetime.datetime.utcfromtimestamp((oldest + 1) * 3600).isoformat()
+        hourly = {}
+        for hour, charged, max_charge in conn.execute("""
+                SELECT CAST(strftime('%s', ts) AS INTEGER) / 3600, SUM(amount), MAX(amount)
+                FROM charge_history WHERE ts >= ? GROUP BY 1
+        """, (since,)):
+            hourly[hour] = [charged, max_charge, 0]
+        for hour, sold in conn.execute("""
+                SELECT CAST(strftime('%s', ts) AS INTEGER) / 3600, COUNT(*)
+                FROM purchases WHERE ts >= ? GROUP BY 1
+        """, (since,)):
+            hourly.setdefault(hour, [0, 0, 0])[2] = sold
+        totals = {
+            "active_users": conn.execute(COUNT_ACTIVE_USERS_AFTER_SQL, (-1,)).fetchone()[0],
+            "total_balance": stored_active_balance(conn, pending),
+            "gift_codes": conn.execute("SELECT COUNT(*) FROM gift_codes").fetchone()[0],
+        }
+    finally:
+        conn.rollback()
+    return product_sales, hourly, totals
+
+def apply_stats(product_sales, hourly, totals):
+    PRODUCT_SALES.clear()
+    PRODUCT_SALES.update(product_sales)
+    STATS_HOURLY.clear()
+    STATS_HOURLY.update(hourly)
+    STATS_TOTALS.update(totals)
+
+def load_stats():
+    """Startup: compute the running stats on the main connection."""
+    pending = USER_STORE.pending()
+    product_sales, hourly, totals = recompute_stats(db, pending)
+    totals["total_balance"] += pending_active_balance(pending)
+    apply_stats(product_sales, hourly, totals)
+
+async def verify_stats():
+    """Compare the running stats with a full recompute on a reader connection (committed data only,
+    off the event loop); on mismatch log it and adopt the recomputed values.
+    Returns the names of the stats that differed, or None when skipped because a write was in flight
+    or committed during the recompute (the database and the running stats could disagree)."""
+    if DB_WRITER.outstanding:
+        return None
+    completed = DB_WRITER.completed
+    pending = USER_STORE.pending()
+    product_sales, hourly, totals = await DB_READERS.run(recompute_stats, pending)
+    if DB_WRITER.outstanding or DB_WRITER.completed != completed or not USER_STORE.pending() <= pending:
+        return None
+    totals["total_balance"] += pending_active_balance(pending)
+    oldest = current_stats_hour() - STATS_WINDOW_HOURS
+    mismatches = []
+    if PRODUCT_SALES != product_sales:
+        mismatches.append("product_sales")
+    if {h: b for h, b in STATS_HOURLY.items() if h > oldest} != hourly:
+        mismatches.append("hourly")
+    mismatches.extend(key for key in totals if STATS_TOTALS[key] != totals[key])
+    if mismatches:
+        logger.warning(f"Running stats out of sync ({', '.join(mismatches)}); adopting the full recompute")
+        apply_stats(product_sales, hourly, totals)
+    return mismatches
+
+async def stats_verify_loop():
+    while True:
+        await asyncio.sleep(STATS_VERIFY_INTERVAL)
+        try:
+            for _ in range(STATS_VERIFY_ATTEMPTS):
+                if await verify_stats() is not None:
+                    break
+                await asyncio.sleep(1)
+        except Exception as e:
+            logger.error(f"Error verifying running stats: {e}")
 
-def write_users_txt():
-    """Write all users info into user.txt in the format:
-    user_id - username - balance"""
-    with open("user.txt", "w", encoding="utf-8") as f:
-        for uid in REGISTERED_USERS:
-            username = USER_INFO.get(uid, "نامشخص")
-            balance = USER_BALANCES.get(uid, 0)
-            f.write(f"{uid} - {username} - {balance}\n")
+# =====================================================================
+# User TXT Export
+# =====================================================================
+def export_users_txt():
+    """Stream all users from the database into user.txt in the format:
+    user_id - username - balance
+    Returns (total_users, total_balance). Runs on a worker thread with its own connection."""
+    total_users = 0
+    total_balance = 0
+    tmp_path = USERS_TXT_PATH + ".tmp"
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.execute("SELECT user_id, username, balance FROM users ORDER BY user_id")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            while True:
+                rows = cursor.fetchmany(USERS_TXT_CHUNK)
+                if not rows:
+                    break
+                f.writelines(f"{uid} - {username or 'نامشخص'} - {balance or 0}\n" for uid, username, balance in rows)
+                total_users += len(rows)
+                total_balance += sum(balance or 0 for _, _, balance in rows)
+    finally:
+        conn.close()
+    os.replace(tmp_path, USERS_TXT_PATH)
+    return total_users, total_balance
+
+async def get_users_txt():
+    """Return (total_users, total_balance) for an up-to-date user.txt, regenerating it only if users changed."""
+    await save_dirty_user_data()
+    version = USERS_DATA_VERSION
+    if USERS_TXT_CACHE["version"] != version or not os.path.exists(USERS_TXT_PATH):
+        total_users, total_balance = await asyncio.to_thread(export_users_txt)
+        USERS_TXT_CACHE.update(version=version, total_users=total_users, total_balance=total_balance)
+    return USERS_TXT_CACHE["total_users"], USERS_TXT_CACHE["total_balance"]
 
 # =====================================================================
 # Helper Functions for Keyboards
 # =====================================================================
+def cached_keyboard(build):
+    """Build the markup on first use and reuse it until invalidate_keyboards() is called."""
+    @functools.wraps(build)
+    def get_keyboard():
+        markup = KEYBOARD_CACHE.get(build.__name__)
+        if markup is None:
+            markup = KEYBOARD_CACHE[build.__name__] = build()
+        return markup
+    return get_keyboard
+
+def invalidate_keyboards():
+    """Drop every cached markup; called whenever products, prices or code files change."""
+    KEYBOARD_CACHE.clear()
+
+def callback_product_id(data: str):
+    """Product id from callback data of the form "<prefix>_<product_id>", or None."""
+    _, _, product_id = data.rpartition("_")
+    return int(product_id) if product_id.isdigit() else None
+
+def callback_product(data: str):
+    """Current name of the product referenced by the callback data, or None if it no longer exists."""
+    return PRODUCT_NAMES.get(callback_product_id(data))
+
+def get_product_picker_keyboard(prefix: str, with_codes_only: bool = False, cancel: bool = False):
+    """One button per product with callback data prefix + product id, plus a main menu or cancel row."""
+    key = ("picker", prefix, with_codes_only, cancel)
+    markup = KEYBOARD_CACHE.get(key)
+    if markup is None:
+        products = [product for product, path in SERVICE_FILE_PATH.items() if path] if with_codes_only else PRODUCT_PRICES
+        keyboard = [[InlineKeyboardButton(product, callback_data=f"{prefix}{PRODUCT_IDS[product]}")]
+                    for product in products]
+        if cancel:
+            keyboard.append([InlineKeyboardButton("انصراف❌", callback_data="admin_cancel")])
+        else:
+            keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
+        markup = KEYBOARD_CACHE[key] = InlineKeyboardMarkup(keyboard)
+    return markup
+
+@cached_keyboard
 def get_main_menu_keyboard():
     keyboard = [
         [KeyboardButton("خرید محصول 🛍")],
@@ -249,12 +1787,14 @@ def get_main_menu_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@cached_keyboard
 def get_inline_main_menu():
     inline_keyboard = [
         [InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")]
     ]
     return InlineKeyboardMarkup(inline_keyboard)
 
+@cached_keyboard
 def get_admin_panel_keyboard():
     keyboard = [
         [InlineKeyboardButton("➕افزودن اعتبار کاربر", callback_data="admin_add_credit"),
@@ -285,6 +1825,7 @@ def get_admin_panel_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@cached_keyboard
 def get_charge_keyboard():
     keyboard = [
         [InlineKeyboardButton("10000", callback_data="charge_10000"),
@@ -295,6 +1836,7 @@ def get_charge_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@cached_keyboard
 def get_user_profile_keyboard():
     keyboard = [
         [InlineKeyboardButton("شارژ حساب 💳", callback_data="profile_charge")],
@@ -303,15 +1845,12 @@ def get_user_profile_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 def get_product_purchase_keyboard():
-    buttons = []
-    for product in PRODUCT_PRICES.keys():
-        buttons.append([InlineKeyboardButton(product, callback_data=f"buy_{product}")])
-    buttons.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
-    return InlineKeyboardMarkup(buttons)
+    return get_product_picker_keyboard("buy_")
 
 # ---------------------------------------------------------------------
 # Updated: Helper Function for Membership Keyboard with Three Inline Buttons
 # ---------------------------------------------------------------------
+@cached_keyboard
 def get_membership_keyboard():
     # Three inline buttons (glass style) each on a separate row.
     keyboard = [
@@ -322,10 +1861,12 @@ def get_membership_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 # New helper: Cancel keyboard for admin conversations
+@cached_keyboard
 def get_admin_cancel_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("انصراف❌", callback_data="admin_cancel")]])
 
 # NEW: Helper function for Payment Method selection (New Feature)
+@cached_keyboard
 def get_payment_method_keyboard():
     keyboard = [
         [InlineKeyboardButton("کارت به کارت 💳", callback_data="card_payment")],
@@ -334,11 +1875,13 @@ def get_payment_method_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 # NEW: Helper function for TRX Payment initiation button
+@cached_keyboard
 def get_trx_initial_keyboard():
     keyboard = [[InlineKeyboardButton("پرداخت با Trx(ترون)🔴", callback_data="trx_payment")]]
     return InlineKeyboardMarkup(keyboard)
 
 # NEW: Helper function for TRX Payment Options (Fixed amounts and Custom)
+@cached_keyboard
 def get_trx_option_keyboard():
     keyboard = [
        [InlineKeyboardButton("10000", callback_data="trx_10000")],
@@ -352,20 +1895,37 @@ def get_trx_option_keyboard():
 # =====================================================================
 # Membership Check Functions
 # =====================================================================
-async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+async def is_channel_member(context: ContextTypes.DEFAULT_TYPE, channel: str, user_id: int) -> bool:
+    try:
+        member = await context.bot.get_chat_member(channel, user_id)
+        return member.status in ["member", "administrator", "creator"]
+    except Exception as e:
+        logger.error(f"Error checking channel {channel} for user {user_id}: {e}")
+        return False
+
+async def get_missing_channel(context: ContextTypes.DEFAULT_TYPE, user_id: int, force_refresh: bool = False):
+    """Return the first mandatory channel the user has not joined, or None.
+    Results are cached per user; negative results expire sooner so joining is noticed quickly."""
+    now = time.monotonic()
+    cached = MEMBERSHIP_CACHE.get(user_id)
+    if cached and not force_refresh and cached[1] > now:
+        MEMBERSHIP_CACHE_STATS["hits"] += 1
+        return cached[0]
+    MEMBERSHIP_CACHE_STATS["misses"] += 1
+    channels = [MANDATORY_CHANNEL, MANDATORY_CHANNEL_2]
+    results = await asyncio.gather(*(is_channel_member(context, channel, user_id) for channel in channels))
+    missing_channel = next((channel for channel, ok in zip(channels, results) if not ok), None)
+    ttl = MEMBERSHIP_CACHE_TTL if missing_channel is None else MEMBERSHIP_NEGATIVE_TTL
+    if len(MEMBERSHIP_CACHE) >= MEMBERSHIP_CACHE_MAX:
+        for uid in [uid for uid, (_, expires) in MEMBERSHIP_CACHE.items() if expires <= now]:
+            del MEMBERSHIP_CACHE[uid]
+    MEMBERSHIP_CACHE[user_id] = (missing_channel, now + ttl)
+    return missing_channel
+
+async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE, force_refresh: bool = False) -> bool:
     user_id = update.effective_user.id
-    missing_channel = None
     # Check both mandatory channels. If any one is missing, prompt the user.
-    for channel in [MANDATORY_CHANNEL, MANDATORY_CHANNEL_2]:
-        try:
-            member = await context.bot.get_chat_member(channel, user_id)
-            if member.status not in ["member", "administrator", "creator"]:
-                missing_channel = channel
-                break
-        except Exception as e:
-            logger.error(f"Error checking channel {channel} for user {user_id}: {e}")
-            missing_channel = channel
-            break
+    missing_channel = await get_missing_channel(context, user_id, force_refresh)
 
     if missing_channel:
         user_first_name = update.effective_user.first_name
@@ -391,8 +1951,8 @@ async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def confirm_membership_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    # After confirmation, check membership for both channels
-    if await check_membership(update, context):
+    # After confirmation, check membership for both channels (bypassing the cache)
+    if await check_membership(update, context, force_refresh=True):
         try:
             await query.edit_message_text("عضویت شما تایید شد. خوش آمدید!", reply_markup=get_main_menu_keyboard())
         except telegram.error.BadRequest as e:
@@ -402,7 +1962,7 @@ async def confirm_membership_callback(update: Update, context: ContextTypes.DEFA
 async def membership_check_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    if await check_membership(update, context):
+    if await check_membership(update, context, force_refresh=True):
         try:
             await query.edit_message_text("عضویت شما تایید شد. خوش آمدید!", reply_markup=get_main_menu_keyboard())
         except telegram.error.BadRequest as e:
@@ -475,12 +2035,95 @@ async def admin_send_phone_file_handler(update: Update, context: ContextTypes.DE
         parse_mode="Markdown"
     )
 
+# =====================================================================
+# NEW: Unreachable User Tracking (blocked bot / deleted account)
+# =====================================================================
+PERMANENT_BAD_REQUESTS = ("chat not found", "user is deactivated", "peer_id_invalid", "bot was blocked")
+
+def is_permanent_delivery_error(error: Exception) -> bool:
+    if isinstance(error, telegram.error.Forbidden):
+        return True
+    if isinstance(error, telegram.error.BadRequest):
+        message = str(error).lower()
+        return any(reason in message for reason in PERMANENT_BAD_REQUESTS)
+    return False
+
+async def mark_users_inactive(user_ids, reason: str):
+    user_ids = [uid for uid in user_ids if uid not in INACTIVE_USERS]
+    if not user_ids:
+        return
+    INACTIVE_USERS.update(user_ids)
+    STATS_TOTALS["active_users"] -= len(user_ids)
+    STATS_TOTALS["total_balance"] -= sum(USER_BALANCES.get(uid, 0) for uid in user_ids)
+    try:
+        await DB_WRITER.submit(write_inactive_users, user_ids, reason)
+    except Exception as e:
+        logger.error(f"Error saving inactive users: {e}")
+
+async def reactivate_user(user_id: int, newly_registered: bool = False):
+    if user_id in INACTIVE_USERS:
+        INACTIVE_USERS.discard(user_id)
+        if not newly_registered:
+            STATS_TOTALS["active_users"] += 1
+        STATS_TOTALS["total_balance"] += USER_BALANCES.get(user_id, 0)
+        await DB_WRITER.submit(delete_inactive_user, user_id)
+
+async def registry_compaction_loop():
+    while True:
+        await asyncio.sleep(REGISTRY_COMPACTION_INTERVAL)
+        try:
+            removed = await asyncio.to_thread(purge_inactive_registered_users)
+            if removed:
+                logger.info(f"Registry compacted: removed {removed} inactive users")
+        except Exception as e:
+            logger.error(f"Error compacting registered users: {e}")
+
+# =====================================================================
+# NEW: Concurrent Update Processing (ordered per user)
+# =====================================================================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes up to max_concurrent_updates updates at once, but the updates of one user strictly
+    in arrival order, so their conversation states and balance checks never interleave.
+    Updates without a user (channel posts, polls) are not ordered."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = weakref.WeakValueDictionary()
+
+    async def process_update(self, update, coroutine) -> None:
+        # Overrides the base class (marked final) to take the user's lock before a concurrency slot:
+        # queued updates of one busy user then wait outside the semaphore instead of holding its slots
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self._locks.get(user.id)
+        if lock is None:
+            lock = self._locks[user.id] = asyncio.Lock()
+        async with lock:
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 # =====================================================================
 # User Handlers
 # =====================================================================
+def get_user_lock(user_id: int) -> asyncio.Lock:
+    lock = USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = USER_LOCKS[user_id] = asyncio.Lock()
+    return lock
+
 async def banned_check_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user_id = update.effective_user.id
-    if BANNED_USERS.get(user_id, False):
+    if user_id in BANNED_USERS:
         if update.message:
             await update.message.reply_text("شما مسدود هستید❌")
         elif update.callback_query:
@@ -491,10 +2134,13 @@ async def banned_check_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     user_id = user.id
-    save_registered_user(user_id)
+    is_new = await register_user(user_id)
+    await reactivate_user(user_id, is_new)
     username = f"@{user.username}" if user.username else user.first_name
-    USER_INFO[user_id] = username
-    write_users_txt()
+    if is_new or USER_INFO.get(user_id) != username:
+        USER_INFO[user_id] = username
+        mark_user_dirty(user_id)
+        await save_dirty_user_data()
     if not BOT_ACTIVE:
         await update.message.reply_text("ربات خاموش است❌")
         return
@@ -522,29 +2168,29 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     query = update.callback_query
     await query.answer()
-    product = query.data.split("_", 1)[1] if "_" in query.data else ""
+    product = callback_product(query.data)
     user_id = query.from_user.id
-    if product not in SERVICE_CODES or not SERVICE_CODES[product]:
-        await query.edit_message_text(text="کد موجود نمی‌باشد❌", reply_markup=get_inline_main_menu())
-        return
-    balance = USER_BALANCES.get(user_id, 0)
-    price = PRODUCT_PRICES.get(product, 30000)
-    if balance < price:
-        await query.edit_message_text(text="موجودی شما کافی نیست❌", reply_markup=get_inline_main_menu())
-        return
-    USER_BALANCES[user_id] = balance - price
-    now = datetime.datetime.utcnow().isoformat()
-    USER_RECENT_PURCHASES.setdefault(user_id, []).append((now, product))
-    USER_PURCHASED[user_id] = USER_PURCHASED.get(user_id, 0) + 1
-    code = SERVICE_CODES[product].pop(0)
-    if not SERVICE_CODES[product]:
+    # Serialize purchases of the same user so double taps cannot spend the balance twice
+    async with get_user_lock(user_id):
+        if not await has_available_code(product):
+            await query.edit_message_text(text="کد موجود نمی‌باشد❌", reply_markup=get_inline_main_menu())
+            return
+        balance = USER_BALANCES.get(user_id, 0)
+        price = PRODUCT_PRICES.get(product, 30000)
+        if balance < price:
+            await query.edit_message_text(text="موجودی شما کافی نیست❌", reply_markup=get_inline_main_menu())
+            return
+        code = await sell_service_code(user_id, product, price)
+        if code is None:
+            await query.edit_message_text(text="کد موجود نمی‌باشد❌", reply_markup=get_inline_main_menu())
+            return
+    if not await has_available_code(product):
         await context.bot.send_message(chat_id=ADMIN_ID,
             text=f"❌کدهای سرویس {product} تمام شده‌اند؛ لطفاً کدها را شارژ کنید.")
     message = ("🛍کد تخفیف شما آماده شد 🤩\n\n"
                f"🛍کد: `{code}`")
     await query.edit_message_text(text=message, parse_mode="Markdown", reply_markup=get_inline_main_menu())
-    write_users_txt()
-    save_all_user_data()
+    await BALANCE_LEDGER.sync()
 
 async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
@@ -585,16 +2231,22 @@ async def gift_code_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def gift_code_redeem_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     code_entered = update.message.text.strip()
+    user_id = update.effective_user.id
     logger.info(f"Received gift code input: {code_entered}")
-    if code_entered in gift_codes and gift_codes[code_entered]["usage"] > 0:
-        amount = gift_codes[code_entered]["amount"]
-        user_id = update.effective_user.id
-        USER_BALANCES[user_id] = USER_BALANCES.get(user_id, 0) + amount
-        gift_codes[code_entered]["usage"] -= 1
-        total = gift_codes[code_entered]["total"]
-        used = total - gift_codes[code_entered]["usage"]
-        USER_GIFT_USAGE[user_id] = USER_GIFT_USAGE.get(user_id, 0) + 1
-        USER_LAST_GIFT_CODE[user_id] = code_entered
+    if not allow_gift_attempt(user_id):
+        logger.warning(f"Gift code attempts throttled for user {user_id}")
+        await update.message.reply_text(
+            f"⏳تعداد تلاش های شما برای وارد کردن کد هدیه بیش از حد مجاز است. لطفاً {GIFT_ATTEMPT_WINDOW // 60} دقیقه دیگر دوباره امتحان کنید."
+        )
+        return ConversationHandler.END
+    async with get_user_lock(user_id):
+        redeemed = await redeem_gift_code(code_entered, user_id)
+    if redeemed == "redeemed":
+        logger.info(f"User {user_id} already redeemed gift code {code_entered}")
+        await update.message.reply_text("❌شما قبلاً از این کد هدیه استفاده کرده اید.")
+    elif redeemed:
+        amount, usage_left, total = redeemed
+        used = total - usage_left
         await context.bot.send_message(
             chat_id=ADMIN_ID,
             text=f"🎁کد هدیه `{code_entered}` توسط کاربر `{user_id}` استفاده شد✅\n\n🌐تعداد استفاده : {used}/{total}",
@@ -603,19 +2255,21 @@ async def gift_code_redeem_handler(update: Update, context: ContextTypes.DEFAULT
         reply_text = f"🎁کاربر {update.effective_user.first_name} تبریک ! مبلغ *{amount}* به اعتبار شما اضافه شد🤩"
         await update.message.reply_text(reply_text, parse_mode="Markdown")
         logger.info(f"Gift code redeemed successfully for user {user_id} with amount {amount}")
+        await BALANCE_LEDGER.sync()
     else:
         logger.info(f"Invalid or exhausted gift code: {code_entered}")
         await update.message.reply_text("کد هدیه شما نامعتبر است❌")
-    write_users_txt()
     return ConversationHandler.END
 
 # =====================================================================
 # NEW: Admin Gift Creation (Manual & Random) Handlers
 # =====================================================================
 # NEW: Define helper to show gift creation choices
+@cached_keyboard
 def get_gift_choice_keyboard():
     keyboard = [
         [InlineKeyboardButton("🎁ساخت کد دستی", callback_data="admin_gift_manual")],
+        [InlineKeyboardButton("🎁ساخت کد انبوه (فایل)", callback_data="admin_gift_bulk")],
         [InlineKeyboardButton("🎁افزودن اعتبار رندوم", callback_data="admin_gift_random")]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -638,6 +2292,10 @@ async def admin_gift_choice_selection(update: Update, context: ContextTypes.DEFA
     elif data == "admin_gift_random":
         await query.edit_message_text("تعداد برندگان اعتبار را وارد کنید:", reply_markup=get_admin_cancel_keyboard())
         return RANDOM_WINNER_COUNT
+    elif data == "admin_gift_bulk":
+        await query.edit_message_text(f"تعداد کدهای هدیه یک بار مصرف را وارد کنید (حداکثر {GIFT_BULK_MAX}):",
+                                      reply_markup=get_admin_cancel_keyboard())
+        return ADMIN_BULK_GIFT_COUNT
 
 async def admin_create_gift_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.message.text.strip()
@@ -656,11 +2314,41 @@ async def admin_create_gift_usage(update: Update, context: ContextTypes.DEFAULT_
         return ADMIN_CREATE_GIFT_USAGE
     usage = int(text)
     amount = context.user_data.get("gift_amount", 0)
-    code = "".join(random.choices(string.ascii_uppercase + string.digits, k=8))
-    gift_codes[code] = {"amount": amount, "usage": usage, "total": usage}
+    code = generate_gift_code()
+    while not await create_gift_code(code, amount, usage):
+        code = generate_gift_code()
     await update.message.reply_text(f"کد هدیه ساخته شد: `{code}`", parse_mode="Markdown", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
+# Handlers for Bulk Gift Code Generation
+async def admin_bulk_gift_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    text = update.message.text.strip()
+    if not text.isdigit() or not 0 < int(text) <= GIFT_BULK_MAX:
+        await update.message.reply_text(f"لطفاً عددی بین 1 و {GIFT_BULK_MAX} وارد کنید!", reply_markup=get_admin_cancel_keyboard())
+        return ADMIN_BULK_GIFT_COUNT
+    context.user_data["bulk_gift_count"] = int(text)
+    await update.message.reply_text("مبلغ هر کد هدیه را وارد کنید :", reply_markup=get_admin_cancel_keyboard())
+    return ADMIN_BULK_GIFT_AMOUNT
+
+async def admin_bulk_gift_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    text = update.message.text.strip()
+    if not text.isdigit():
+        await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
+        return ADMIN_BULK_GIFT_AMOUNT
+    amount = int(text)
+    count = context.user_data.get("bulk_gift_count", 0)
+    status = await update.message.reply_text(f"⏳در حال ساخت {count} کد هدیه...")
+    codes = await create_gift_codes(count, amount)
+    logger.info(f"Created {len(codes)} single-use gift codes of {amount}")
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=await asyncio.to_thread(export_gift_codes, codes),
+        filename=f"gift_codes_{amount}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+        caption=f"🎁{len(codes)} کد هدیه یک بار مصرف به مبلغ {amount} ساخته شد✅"
+    )
+    await status.edit_text("کدهای هدیه ساخته شدند✅", reply_markup=get_admin_panel_keyboard())
+    return ConversationHandler.END
+
 # Handlers for Random Credit Addition
 async def admin_gift_random_winner_count(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.message.text.strip()
@@ -679,45 +2367,98 @@ async def admin_gift_random_amount_handler(update: Update, context: ContextTypes
     amount = int(text)
     context.user_data["random_credit_amount"] = amount
     count = context.user_data.get("random_winner_count")
-    winners = random.sample(list(REGISTERED_USERS), min(count, len(REGISTERED_USERS)))
+    context.application.create_task(run_random_payout(context.bot, update.effective_chat.id, count, amount))
+    await update.message.reply_text("⏳قرعه کشی در پس زمینه انجام می شود؛ پس از پایان گزارش آن ارسال می شود.",
+                                    reply_markup=get_admin_panel_keyboard())
+    return ConversationHandler.END
+
+async def rate_limited_call(call, *args, **kwargs):
+    """Run a Bot API call under the shared broadcast rate limit, retrying flood waits and network errors."""
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await BROADCAST_BUCKET.acquire()
+        try:
+            return await call(*args, **kwargs)
+        except telegram.error.RetryAfter as e:
+            BROADCAST_BUCKET.pause(retry_after_seconds(e))
+        except (telegram.error.TimedOut, telegram.error.NetworkError):
+            if attempt == BROADCAST_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+    raise telegram.error.TimedOut(f"{BROADCAST_MAX_ATTEMPTS} attempts failed")
+
+async def fetch_first_names(bot, user_ids):
+    """user_id -> first name (or "نامشخص"), one concurrent get_chat per user."""
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def fetch(uid):
+        async with semaphore:
+            try:
+                chat = await rate_limited_call(bot.get_chat, uid)
+                return chat.first_name or "نامشخص"
+            except Exception:
+                return "نامشخص"
+
+    return dict(zip(user_ids, await asyncio.gather(*(fetch(uid) for uid in user_ids))))
+
+def split_message(lines, header: str, footer: str, limit: int = 4096):
+    """Join lines into as few messages as possible, each within Telegram's length limit."""
+    messages, current = [], header
+    for line in lines:
+        if len(current) + len(line) > limit - len(footer):
+            messages.append(current)
+            current = ""
+        current += line
+    messages.append(current + footer)
+    return messages
+
+async def run_random_payout(bot, admin_chat_id: int, count: int, amount: int):
+    """Credit amount to count random active users, notify them and announce the winners in the channel."""
+    winners = await sample_active_users(count)
     for uid in winners:
-         USER_BALANCES[uid] = USER_BALANCES.get(uid, 0) + amount
-         try:
-             chat = await context.bot.get_chat(uid)
-             user_name = chat.first_name if chat.first_name else "نامشخص"
-         except Exception:
-             user_name = "نامشخص"
-         try:
-             await context.bot.send_message(
-                  chat_id=uid,
-                  text=f"🎁کاربر *{user_name}* شما برنده مبلغ *{amount}* در ربات فود سنتر شدید🤩🥳",
-                  parse_mode="Markdown"
-             )
-         except Exception as e:
-             logger.error(f"Error sending message to {uid}: {e}")
-    channel_message = "🎁برندگان چالش :\n\n"
+        async with get_user_lock(uid):
+            adjust_balance(uid, amount)
+    # All credits reach the ledger in one group commit before anyone is told about them
+    await BALANCE_LEDGER.sync()
+    names = await fetch_first_names(bot, winners)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def notify(uid):
+        async with semaphore:
+            try:
+                await rate_limited_call(
+                    bot.send_message,
+                    chat_id=uid,
+                    text=f"🎁کاربر *{names[uid]}* شما برنده مبلغ *{amount}* در ربات فود سنتر شدید🤩🥳",
+                    parse_mode="Markdown"
+                )
+                return None
+            except Exception as e:
+                logger.error(f"Error sending message to {uid}: {e}")
+                return e
+
+    results = await asyncio.gather(*(notify(uid) for uid in winners))
+    unreachable = [uid for uid, error in zip(winners, results) if error is not None and is_permanent_delivery_error(error)]
+    if unreachable:
+        await mark_users_inactive(unreachable, "random payout")
+    lines = []
     for i, uid in enumerate(winners, start=1):
-         try:
-              chat = await context.bot.get_chat(uid)
-              user_name = chat.first_name if chat.first_name else "نامشخص"
-         except Exception:
-              user_name = "نامشخص"
          uid_str = str(uid)
          if len(uid_str) > 3:
              masked = uid_str[:-3] + "***"
          else:
              masked = uid_str + "***"
-         channel_message += f"{i}- کاربر *{user_name}* با آیدی عددی `{masked}` مبلغ *{amount}* دریافت کرد😇🥳\n\n"
-    channel_message += "\n🤖 @Food_center_Pbot | ربات فود سنتر 🍔"
-    await context.bot.send_message(
-         chat_id=MANDATORY_CHANNEL,
-         text=channel_message,
-         parse_mode="Markdown"
+         lines.append(f"{i}- کاربر *{names[uid]}* با آیدی عددی `{masked}` مبلغ *{amount}* دریافت کرد😇🥳\n\n")
+    for channel_message in split_message(lines, "🎁برندگان چالش :\n\n", "\n🤖 @Food_center_Pbot | ربات فود سنتر 🍔"):
+        try:
+            await rate_limited_call(bot.send_message, chat_id=MANDATORY_CHANNEL, text=channel_message, parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Error announcing random payout winners: {e}")
+    failed = sum(1 for error in results if error is not None)
+    logger.info(f"Random payout: {len(winners)} winners credited {amount}, {failed} notifications failed")
+    await bot.send_message(
+        chat_id=admin_chat_id,
+        text=f"اعتبار به برندگان اضافه شد✅\n\n👥تعداد برندگان : {len(winners)}\n❌پیام های ناموفق : {failed}"
     )
-    write_users_txt()
-    save_all_user_data()
-    await update.message.reply_text("اعتبار به برندگان اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    return ConversationHandler.END
 
 # =====================================================================
 # NEW: Admin Handler for Backing Up the Database
@@ -725,10 +2466,13 @@ async def admin_gift_random_amount_handler(update: Update, context: ContextTypes
 async def admin_backup_db_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
+    backup_path = DB_PATH + ".backup"
     try:
+        await save_dirty_user_data()
+        await asyncio.to_thread(backup_database, backup_path)
         await context.bot.send_document(
             chat_id=ADMIN_ID,
-            document=open("user_data.db", "rb"),
+            document=open(backup_path, "rb"),
             caption="🖨بکاپ گیری دیتابیس"
         )
     except Exception as e:
@@ -752,14 +2496,12 @@ async def admin_ban_userid(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("لطفاً آیدی عددی معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
         return ADMIN_BAN_USERID
     target_id = int(text)
-    BANNED_USERS[target_id] = True
-    add_banned_user(target_id)  # ذخیره در دیتابیس
+    await add_banned_user(target_id)  # ذخیره در دیتابیس
     try:
         await context.bot.send_message(chat_id=target_id, text="شما بن شده‌اید ❌")
     except Exception as e:
         await update.message.reply_text(f"خطا: {e}")
     await update.message.reply_text("کاربر بن شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_unblock_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -777,15 +2519,13 @@ async def admin_unblock_userid(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("لطفاً آیدی عددی معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
         return ADMIN_UNBLOCK_USERID
     target_id = int(text)
-    if BANNED_USERS.get(target_id, False):
-        BANNED_USERS[target_id] = False
-        remove_banned_user(target_id)  # حذف از دیتابیس
+    if target_id in BANNED_USERS:
+        await remove_banned_user(target_id)  # حذف از دیتابیس
         try:
             await context.bot.send_message(chat_id=target_id, text="شما آزاد شدید✅")
         except Exception as e:
             await update.message.reply_text(f"خطا: {e}")
         await update.message.reply_text("کاربر آزاد شد.", reply_markup=get_admin_panel_keyboard())
-        save_all_user_data()
     else:
         await update.message.reply_text("کاربر مسدود نیست.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
@@ -805,8 +2545,7 @@ async def admin_banned_list_handler(update: Update, context: ContextTypes.DEFAUL
         page = 0
     limit = 10
     offset = page * limit
-    banned_list = get_banned_users(offset, limit)
-    total_banned = count_banned_users()
+    banned_list, total_banned = await asyncio.gather(get_banned_users(offset, limit), count_banned_users())
     if not banned_list:
         text = "هیچ کاربر مسدودی موجود نیست."
     else:
@@ -909,11 +2648,8 @@ async def admin_receive_button_price(update: Update, context: ContextTypes.DEFAU
         return ADD_BUTTON_PRICE
     price = int(text)
     button_name = context.user_data.get("new_button_name")
-    PRODUCT_PRICES[button_name] = price
-    SERVICE_CODES[button_name] = []
-    SERVICE_FILE_PATH[button_name] = ""
+    await add_product(button_name, price)
     await update.message.reply_text(f"دکمه '{button_name}' با قیمت {price} اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_remove_button_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -926,25 +2662,16 @@ async def admin_remove_button_start(update: Update, context: ContextTypes.DEFAUL
     if not PRODUCT_PRICES:
         await query.edit_message_text("هیچ دکمه‌ای موجود نیست.", reply_markup=get_admin_panel_keyboard())
         return ConversationHandler.END
-    keyboard = []
-    for product in PRODUCT_PRICES.keys():
-        keyboard.append([InlineKeyboardButton(product, callback_data=f"remove_{product}")])
-    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
-    await query.edit_message_text("لطفاً دکمه‌ای برای حذف انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("لطفاً دکمه‌ای برای حذف انتخاب کنید:", reply_markup=get_product_picker_keyboard("remove_"))
     return REMOVE_BUTTON_SELECT
 
 async def admin_remove_button_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    product = query.data.split("_", 1)[1] if "_" in query.data else ""
+    product = callback_product(query.data)
     if product in PRODUCT_PRICES:
-        del PRODUCT_PRICES[product]
-    if product in SERVICE_CODES:
-        del SERVICE_CODES[product]
-    if product in SERVICE_FILE_PATH:
-        del SERVICE_FILE_PATH[product]
+        await delete_product(product)
     await query.edit_message_text(f"دکمه '{product}' حذف شد.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_increase_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -953,32 +2680,30 @@ async def admin_increase_start(update: Update, context: ContextTypes.DEFAULT_TYP
     if query.from_user.id != ADMIN_ID:
         await query.edit_message_text("دسترسی ندارید.")
         return ConversationHandler.END
-    keyboard = []
-    for product in PRODUCT_PRICES.keys():
-        keyboard.append([InlineKeyboardButton(product, callback_data=f"increase_{product}")])
-    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
-    await query.edit_message_text("کدام محصول را می‌خواهید قیمتش را افزایش دهید؟", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("کدام محصول را می‌خواهید قیمتش را افزایش دهید؟", reply_markup=get_product_picker_keyboard("increase_"))
     return INCREASE_PRODUCT_SELECT
 
 async def admin_increase_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    product = query.data.split("_", 1)[1]
-    context.user_data["target_product"] = product
+    product = callback_product(query.data)
+    context.user_data["target_product"] = callback_product_id(query.data)
     current_price = PRODUCT_PRICES.get(product, 0)
     await query.edit_message_text(f"نام محصول: {product}\nقیمت فعلی: {current_price}\nلطفاً قیمت جدید را وارد کنید:", reply_markup=get_admin_cancel_keyboard())
     return INCREASE_PRODUCT_INPUT
 
 async def admin_increase_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("target_product", "")
+    product = PRODUCT_NAMES.get(context.user_data.get("target_product"))
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
         return INCREASE_PRODUCT_INPUT
     new_price = int(text)
-    PRODUCT_PRICES[product] = new_price
+    if product not in PRODUCT_PRICES:
+        await update.message.reply_text("محصول مورد نظر پیدا نشد.", reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    await set_product_price(product, new_price)
     await update.message.reply_text(f"قیمت {product} به {new_price} تغییر یافت.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_decrease_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -987,32 +2712,30 @@ async def admin_decrease_start(update: Update, context: ContextTypes.DEFAULT_TYP
     if query.from_user.id != ADMIN_ID:
         await query.edit_message_text("دسترسی ندارید.")
         return ConversationHandler.END
-    keyboard = []
-    for product in PRODUCT_PRICES.keys():
-        keyboard.append([InlineKeyboardButton(product, callback_data=f"decrease_{product}")])
-    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
-    await query.edit_message_text("کدام محصول را می‌خواهید قیمتش را کاهش دهید؟", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("کدام محصول را می‌خواهید قیمتش را کاهش دهید؟", reply_markup=get_product_picker_keyboard("decrease_"))
     return DECREASE_PRODUCT_SELECT
 
 async def admin_decrease_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    product = query.data.split("_", 1)[1]
-    context.user_data["target_product"] = product
+    product = callback_product(query.data)
+    context.user_data["target_product"] = callback_product_id(query.data)
     current_price = PRODUCT_PRICES.get(product, 0)
     await query.edit_message_text(f"نام محصول: {product}\nقیمت فعلی: {current_price}\nلطفاً قیمت جدید را وارد کنید:", reply_markup=get_admin_cancel_keyboard())
     return DECREASE_PRODUCT_INPUT
 
 async def admin_decrease_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("target_product", "")
+    product = PRODUCT_NAMES.get(context.user_data.get("target_product"))
     text = update.message.text.strip()
     if not text.isdigit():
         await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
         return DECREASE_PRODUCT_INPUT
     new_price = int(text)
-    PRODUCT_PRICES[product] = new_price
+    if product not in PRODUCT_PRICES:
+        await update.message.reply_text("محصول مورد نظر پیدا نشد.", reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    await set_product_price(product, new_price)
     await update.message.reply_text(f"قیمت {product} به {new_price} تغییر یافت.", reply_markup=get_admin_panel_keyboard())
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_delete_code_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1021,35 +2744,31 @@ async def admin_delete_code_start(update: Update, context: ContextTypes.DEFAULT_
     if query.from_user.id != ADMIN_ID:
         await query.edit_message_text("دسترسی ندارید.")
         return ConversationHandler.END
-    if not SERVICE_CODES:
+    products_with_codes = [product for product, path in SERVICE_FILE_PATH.items() if path]
+    if not products_with_codes:
         await query.edit_message_text("هیچ کدی برای حذف موجود نیست.", reply_markup=get_admin_panel_keyboard())
         return ConversationHandler.END
-    keyboard = []
-    for product in SERVICE_CODES.keys():
-        keyboard.append([InlineKeyboardButton(product, callback_data=f"delete_{product}")])
-    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
-    await query.edit_message_text("سرویس مورد نظر جهت حذف کد تخفیف را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("سرویس مورد نظر جهت حذف کد تخفیف را انتخاب کنید:",
+                                  reply_markup=get_product_picker_keyboard("delete_", with_codes_only=True))
     return ADMIN_DELETE_CODE_SERVICE
 
 async def admin_delete_code_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    product = query.data.split("_", 1)[1]
-    context.user_data["delete_service"] = product
+    product = callback_product(query.data)
+    context.user_data["delete_service"] = callback_product_id(query.data)
     file_path = SERVICE_FILE_PATH.get(product, "مسیر فایل یافت نشد.")
     msg = f"سرویس: {product}\nمسیر فایل ثبت شده:\n{file_path}\n\nلطفاً همان مسیر را جهت تأیید حذف وارد کنید:"
     await query.edit_message_text(msg, reply_markup=get_admin_cancel_keyboard())
     return ADMIN_DELETE_CODE_INPUT
 
 async def admin_delete_code_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    product = context.user_data.get("delete_service", "")
+    product = PRODUCT_NAMES.get(context.user_data.get("delete_service"))
     input_path = update.message.text.strip()
     stored_path = SERVICE_FILE_PATH.get(product, "")
-    if input_path == stored_path:
-        SERVICE_CODES[product] = []
-        del SERVICE_FILE_PATH[product]
+    if stored_path and input_path == stored_path:
+        await clear_product_codes(product)
         await update.message.reply_text("کدهای سرویس حذف شدند✅", reply_markup=get_admin_panel_keyboard())
-        save_all_user_data()
     else:
         await update.message.reply_text("مسیر وارد شده مطابقت ندارد.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
@@ -1080,19 +2799,18 @@ async def admin_add_credit_userid(update: Update, context: ContextTypes.DEFAULT_
         return ADMIN_ADD_USERID
     target_id = int(text)
     amount = context.user_data.get("admin_credit_amount", 0)
-    new_balance = USER_BALANCES.get(target_id, 0) + amount
-    USER_BALANCES[target_id] = new_balance
-    USER_CHARGED[target_id] = USER_CHARGED.get(target_id, 0) + amount
+    async with get_user_lock(target_id):
+        USER_CHARGED[target_id] = USER_CHARGED.get(target_id, 0) + amount
+        new_balance = adjust_balance(target_id, amount)
+    await BALANCE_LEDGER.sync()
     try:
         await context.bot.send_message(chat_id=target_id,
             text=f"موجودی شما به مبلغ {amount} شارژ شد. موجودی جدید: {new_balance}")
     except Exception as e:
         await update.message.reply_text(f"خطا در ارسال پیام به کاربر: {e}")
-    now = datetime.datetime.utcnow()
-    charge_history.append((now, target_id, amount))
+    await record_charge(target_id, amount)
     await update.message.reply_text("اعتبار کاربر اضافه شد.", reply_markup=get_admin_panel_keyboard())
-    write_users_txt()
-    save_all_user_data()
+    await save_dirty_user_data()
     return ConversationHandler.END
 
 async def admin_subtract_credit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1121,8 +2839,9 @@ async def admin_subtract_credit_userid(update: Update, context: ContextTypes.DEF
         return ADMIN_SUB_USERID
     target_id = int(text)
     amount = context.user_data.get("admin_sub_amount", 0)
-    new_balance = USER_BALANCES.get(target_id, 0) - amount
-    USER_BALANCES[target_id] = new_balance
+    async with get_user_lock(target_id):
+        new_balance = adjust_balance(target_id, -amount)
+    await BALANCE_LEDGER.sync()
     try:
         await context.bot.send_message(chat_id=target_id,
             text=f"موجودی شما به مبلغ {amount} کاهش یافت. موجودی جدید: {new_balance}")
@@ -1130,8 +2849,6 @@ async def admin_subtract_credit_userid(update: Update, context: ContextTypes.DEF
         await update.message.reply_text(f"خطا در ارسال پیام به کاربر: {e}", reply_markup=get_admin_panel_keyboard())
         return ConversationHandler.END
     await update.message.reply_text("اعتبار کسر شد.", reply_markup=get_admin_panel_keyboard())
-    write_users_txt()
-    save_all_user_data()
     return ConversationHandler.END
 
 async def admin_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1209,12 +2926,168 @@ async def admin_recent_purchases_userid(update: Update, context: ContextTypes.DE
     target_id = int(text)
     now = datetime.datetime.utcnow()
     week_ago = now - datetime.timedelta(days=7)
-    purchases = USER_RECENT_PURCHASES.get(target_id, [])
-    recent = [str(product) for (timestamp, product) in purchases if datetime.datetime.fromisoformat(timestamp) >= week_ago]
+    recent = await get_user_purchases_since(target_id, week_ago)
     msg = f"خریدهای اخیر (۷ روز):\n" + ("\n".join(recent) if recent else "هیچ خریدی ثبت نشده است.")
     await update.message.reply_text(msg, reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
+# =====================================================================
+# NEW: Background Broadcast Engine (rate limited, resumable)
+# =====================================================================
+class TokenBucket:
+    """Async token bucket; pause() stops all callers, e.g. after a RetryAfter flood wait."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+BROADCAST_BUCKET = TokenBucket(BROADCAST_RATE)
+
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+async def deliver_broadcast(bot, job: dict, user_id: int):
+    """Return True when delivered, False on failure, or the error when the chat is permanently unreachable."""
+    last_attempt = 0.0
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        wait = last_attempt + BROADCAST_PER_CHAT_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await BROADCAST_BUCKET.acquire()
+        last_attempt = time.monotonic()
+        try:
+            if job["kind"] == "forward":
+                await bot.forward_message(chat_id=user_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+            else:
+                await bot.send_message(chat_id=user_id, text=job["text"])
+            return True
+        except telegram.error.RetryAfter as e:
+            delay = retry_after_seconds(e)
+            logger.warning(f"Broadcast {job['job_id']}: flood wait {delay}s")
+            BROADCAST_BUCKET.pause(delay)
+        except telegram.error.BadRequest as e:
+            logger.error(f"خطا در ارسال پیام به کاربر {user_id}: {e}")
+            return e if is_permanent_delivery_error(e) else False
+        except (telegram.error.TimedOut, telegram.error.NetworkError):
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            logger.error(f"خطا در ارسال پیام به کاربر {user_id}: {e}")
+            return e if is_permanent_delivery_error(e) else False
+    return False
+
+def format_broadcast_progress(job: dict, done: int, total: int, rate: float, finished: bool = False) -> str:
+    title = f"✅ارسال همگانی #{job['job_id']} به پایان رسید" if finished else f"📤ارسال همگانی #{job['job_id']} در حال انجام..."
+    return (
+        f"{title}\n\n"
+        f"📊پیشرفت : {done}/{total}\n"
+        f"✅موفق : {job['sent']}\n"
+        f"❌ناموفق : {job['failed']}\n"
+        f"🚫کاربران غیرفعال : {len(INACTIVE_USERS)}\n"
+        f"⚡️سرعت : {rate:.1f} پیام در ثانیه"
+    )
+
+async def edit_broadcast_progress(bot, job: dict, text: str):
+    if not job["progress_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(chat_id=job["admin_chat_id"], message_id=job["progress_message_id"], text=text)
+    except Exception as e:
+        logger.error(f"Error editing broadcast progress: {e}")
+
+async def run_broadcast_job(bot, job_id: int):
+    """Deliver a broadcast to every registered user after the job's cursor, persisting progress per batch."""
+    job = await get_broadcast_job(job_id)
+    if not job or job["status"] != "running":
+        return
+    already_done = job["sent"] + job["failed"]
+    total = already_done + await count_active_users_after(job["last_user_id"])
+    processed = 0
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = time.monotonic()
+    last_report = 0.0
+
+    async def deliver(uid):
+        async with semaphore:
+            return await deliver_broadcast(bot, job, uid)
+
+    while True:
+        batch = await get_active_users_page(job["last_user_id"], BROADCAST_BATCH)
+        if not batch:
+            break
+        results = await asyncio.gather(*(deliver(uid) for uid in batch))
+        ok = sum(1 for result in results if result is True)
+        job["sent"] += ok
+        job["failed"] += len(results) - ok
+        unreachable = [uid for uid, result in zip(batch, results) if isinstance(result, Exception)]
+        if unreachable:
+            await mark_users_inactive(unreachable, f"broadcast {job_id}")
+        job["last_user_id"] = batch[-1]
+        await DB_WRITER.submit(update_broadcast_job, job_id, job["last_user_id"], job["sent"], job["failed"])
+        processed += len(batch)
+        now = time.monotonic()
+        if now - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = now
+            rate = processed / max(now - started, 1e-6)
+            await edit_broadcast_progress(bot, job, format_broadcast_progress(job, already_done + processed, total, rate))
+    await DB_WRITER.submit(update_broadcast_job, job_id, job["last_user_id"], job["sent"], job["failed"], "done")
+    done = already_done + processed
+    rate = processed / max(time.monotonic() - started, 1e-6)
+    await edit_broadcast_progress(bot, job, format_broadcast_progress(job, done, max(total, done), rate, finished=True))
+    logger.info(f"Broadcast {job_id} finished: {job['sent']} sent, {job['failed']} failed")
+
+async def start_broadcast_job(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, **payload) -> None:
+    progress = await update.message.reply_text(f"📤ارسال همگانی برای {STATS_TOTALS['active_users']} کاربر در صف قرار گرفت...")
+    job_id = await asyncio.to_thread(
+        create_broadcast_job, kind, update.effective_chat.id, progress.message_id, **payload
+    )
+    context.application.create_task(run_broadcast_job(context.bot, job_id))
+
+async def resume_broadcast_jobs(application: Application) -> None:
+    for job_id in await get_running_broadcast_jobs():
+        logger.info(f"Resuming broadcast {job_id}")
+        application.create_task(run_broadcast_job(application.bot, job_id))
+
+async def on_startup(application: Application) -> None:
+    DB_WRITER.start()
+    await resume_broadcast_jobs(application)
+    application.create_task(registry_compaction_loop())
+    application.create_task(stats_verify_loop())
+    application.create_task(load_code_index())
+    await TRX_PRICE_FEED.start()
+    application.create_task(TRX_PRICE_FEED.run())
+    application.create_task(BALANCE_LEDGER.run())
+    application.create_task(balance_snapshot_loop())
+
+async def on_shutdown(application: Application) -> None:
+    await TRX_PRICE_FEED.close()
+    await DB_WRITER.close()
+    await snapshot_balances()
+    BALANCE_LEDGER.close()
+
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -1226,12 +3099,8 @@ async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def admin_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     msg = update.message.text.strip()
-    for user in REGISTERED_USERS:
-        try:
-            await context.bot.send_message(chat_id=user, text=msg)
-        except Exception as e:
-            logger.error(f"خطا در ارسال پیام به کاربر {user}: {e}")
-    await update.message.reply_text("پیام با موفقیت ارسال شد.", reply_markup=get_admin_panel_keyboard())
+    await start_broadcast_job(update, context, "text", text=msg)
+    await update.message.reply_text("ارسال پیام در پس‌زمینه آغاز شد.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
 async def admin_forward_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1246,14 +3115,8 @@ async def admin_forward_start(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def admin_forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     admin_chat_id = update.message.chat_id
     message_id = update.message.message_id
-    forwarded_count = 0
-    for user in REGISTERED_USERS:
-        try:
-            await context.bot.forward_message(chat_id=user, from_chat_id=admin_chat_id, message_id=message_id)
-            forwarded_count += 1
-        except Exception as e:
-            logger.error(f"خطا در فوروارد پیام به کاربر {user}: {e}")
-    await update.message.reply_text(f"پیام به {forwarded_count} کاربر فوروارد شد.", reply_markup=get_admin_panel_keyboard())
+    await start_broadcast_job(update, context, "forward", from_chat_id=admin_chat_id, message_id=message_id)
+    await update.message.reply_text("فوروارد پیام در پس‌زمینه آغاز شد.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
 async def admin_turn_off_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1273,6 +3136,7 @@ async def admin_turn_on_bot(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # =====================================================================
 # NEW: Admin Stats Panel and Product Statistics Handlers (Capability 1)
 # =====================================================================
+@cached_keyboard
 def get_stats_panel_keyboard():
     keyboard = [
         [InlineKeyboardButton("🛍آمار محصولات", callback_data="stats_products")],
@@ -1289,29 +3153,17 @@ async def admin_stats_panel_handler(update: Update, context: ContextTypes.DEFAUL
 async def stats_products_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    keyboard = []
-    for product in PRODUCT_PRICES.keys():
-        keyboard.append([InlineKeyboardButton(product, callback_data=f"stats_product_{product}")])
-    keyboard.append([InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")])
-    await query.edit_message_text("برای مشاهده آمار محصولات، محصول مورد نظر را انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("برای مشاهده آمار محصولات، محصول مورد نظر را انتخاب کنید:", reply_markup=get_product_picker_keyboard("stats_product_"))
 
 async def stats_product_details_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    product = query.data.replace("stats_product_", "", 1)
+    product = callback_product(query.data)
     price = PRODUCT_PRICES.get(product, 0)
-    total_codes = 0
-    file_path = SERVICE_FILE_PATH.get(product, "")
-    if file_path and os.path.exists(file_path):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                total_codes = sum(1 for _ in f)
-        except Exception as e:
-            logger.error(f"Error reading file for {product}: {e}")
-    sold_count = 0
-    for purchases in USER_RECENT_PURCHASES.values():
-        sold_count += sum(1 for (_, prod) in purchases if prod == product)
-    available = total_codes - sold_count if total_codes >= sold_count else 0
+    total_codes = PRODUCT_CODE_TOTALS.get(product, 0)
+    # Both counts come from the stored codes: sales migrated from the legacy lists have no stored code
+    available = await count_available_codes(product) if product in PRODUCT_IDS else 0
+    sold_count = max(total_codes - available, 0)
     message_text = (
         f"📊آمار محصول:\n"
         f"💵قیمت محصول : {price}\n"
@@ -1320,7 +3172,7 @@ async def stats_product_details_handler(update: Update, context: ContextTypes.DE
         f"📜کد های موجود : {available}"
     )
     inline_kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📌آمار فروش", callback_data=f"sales_stats_{product}")],
+        [InlineKeyboardButton("📌آمار فروش", callback_data=f"sales_stats_{PRODUCT_IDS.get(product)}")],
         [InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")]
     ])
     await query.edit_message_text(message_text, reply_markup=inline_kb, parse_mode="Markdown")
@@ -1328,28 +3180,20 @@ async def stats_product_details_handler(update: Update, context: ContextTypes.DE
 async def sales_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    product = query.data.replace("sales_stats_", "", 1)
-    price = PRODUCT_PRICES.get(product, 0)
-    sold_count = 0
-    buyers = {}
-    for user_id, purchases in USER_RECENT_PURCHASES.items():
-        count = sum(1 for (_, prod) in purchases if prod == product)
-        if count:
-            sold_count += count
-            buyers[user_id] = count
-    total_revenue = sold_count * price
+    product = callback_product(query.data)
+    _, total_revenue = get_product_sales(product)
+    buyers = await get_product_buyers(product)
     message_text = f"💳درآمد کل : {total_revenue}\n"
     message_text += "👤کاربرانی که خریدند :\n"
-    for user_id, count in buyers.items():
+    for user_id, count, amount_paid in buyers:
         try:
             chat = await context.bot.get_chat(user_id)
             name = chat.first_name if chat.first_name else "ناموجود"
         except Exception:
             name = "ناموجود"
-        amount_paid = count * price
         message_text += f"👤کاربر ({name}) - (ناموجود) - `{user_id}` - *{amount_paid}*\n"
     inline_kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("بازگشت به آمار محصول", callback_data=f"stats_product_{product}")],
+        [InlineKeyboardButton("بازگشت به آمار محصول", callback_data=f"stats_product_{PRODUCT_IDS.get(product)}")],
         [InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")]
     ])
     await query.edit_message_text(message_text, reply_markup=inline_kb, parse_mode="Markdown")
@@ -1357,19 +3201,14 @@ async def sales_stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 # =====================================================================
 # NEW: Generate User Stats Function (Capability 2)
 # =====================================================================
-def generate_user_stats():
-    total_users = len(REGISTERED_USERS)
-    total_balance = sum(USER_BALANCES.get(uid, 0) for uid in REGISTERED_USERS)
-    users = []
-    for uid in REGISTERED_USERS:
-        balance = USER_BALANCES.get(uid, 0)
-        purchased = USER_PURCHASED.get(uid, 0)
-        users.append((uid, balance, purchased))
-    users_sorted = sorted(users, key=lambda x: (-x[1], -x[2], x[0]))
-    top_users = users_sorted[:10]
+async def generate_user_stats():
+    total_users = STATS_TOTALS["active_users"]
+    total_balance = STATS_TOTALS["total_balance"]
+    top_users = await get_top_balances(10)
     number_emojis = ['1⃣', '2⃣', '3⃣', '4⃣', '5⃣', '6⃣', '7⃣', '8⃣', '9⃣', '🔟']
     lines = []
     lines.append(f"👤تعداد کل کاربران ربات : *{total_users}*")
+    lines.append(f"🚫کاربرانی که ربات را مسدود کرده‌اند : *{len(INACTIVE_USERS)}*")
     lines.append(f"💳موجودی تمام کاربران : *{total_balance}*")
     lines.append("➖➖➖➖➖➖➖➖➖➖")
     lines.append("🔸10 کاربر برتر ربات (اولویت با موجودی، سپس تعداد خریدها):")
@@ -1380,7 +3219,7 @@ def generate_user_stats():
     return message
 
 async def stats_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    message = generate_user_stats()
+    message = await generate_user_stats()
     inline_kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("🔍جستوجوی کاربر", callback_data="search_user_button")],
         [InlineKeyboardButton("منوی اصلی 🏠", callback_data="menu_main")]
@@ -1395,14 +3234,11 @@ async def stats_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def stats_overall_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    now = datetime.datetime.utcnow()
-    week_ago = now - datetime.timedelta(days=7)
-    total_charged_7 = sum(amount for (timestamp, uid, amount) in charge_history if timestamp >= week_ago)
-    max_charge_7 = max((amount for (timestamp, uid, amount) in charge_history if timestamp >= week_ago), default=0)
-    sold_codes_7 = 0
-    for purchases in USER_RECENT_PURCHASES.values():
-        sold_codes_7 += sum(1 for (timestamp, prod) in purchases if datetime.datetime.fromisoformat(timestamp) >= week_ago)
-    total_gift_codes = len(gift_codes)
+    total_charged_7, max_charge_7, sold_codes_7 = get_window_stats()
+    total_gift_codes = STATS_TOTALS["gift_codes"]
+    cache_hits = MEMBERSHIP_CACHE_STATS["hits"]
+    cache_misses = MEMBERSHIP_CACHE_STATS["misses"]
+    writer = DB_WRITER.metrics()
     message = (
         f"💰کل موجودی شارژ شده در 7 روز اخیر : {total_charged_7}\n"
         "➖➖➖➖➖➖➖➖➖➖\n"
@@ -1410,7 +3246,13 @@ async def stats_overall_handler(update: Update, context: ContextTypes.DEFAULT_TY
         "➖➖➖➖➖➖➖➖➖➖\n"
         f"🛍تمام کد های فروش رفته در 7 روز اخیر: {sold_codes_7}\n"
         "➖➖➖➖➖➖➖➖➖➖\n"
-        f"🎁تعداد همه ی کد هدیه های ساخته شده: {total_gift_codes}"
+        f"🎁تعداد همه ی کد هدیه های ساخته شده: {total_gift_codes}\n"
+        "➖➖➖➖➖➖➖➖➖➖\n"
+        f"🔁کش عضویت کانال : {cache_hits} hit / {cache_misses} miss\n"
+        "➖➖➖➖➖➖➖➖➖➖\n"
+        f"💾نوشتن دیتابیس : {writer['writes']} عملیات در {writer['batches']} تراکنش "
+        f"(میانگین {writer['avg_batch']:.1f}، بیشترین {writer['largest_batch']})، "
+        f"زمان commit میانگین {writer['avg_commit_ms']:.1f}ms / بیشترین {writer['slowest_commit_ms']:.1f}ms"
     )
     await query.edit_message_text(message, reply_markup=get_stats_panel_keyboard(), parse_mode="Markdown")
 
@@ -1436,11 +3278,9 @@ async def search_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         username = "ناموجود"
     balance = USER_BALANCES.get(uid, 0)
     purchased = USER_PURCHASED.get(uid, 0)
-    gift_usage = USER_GIFT_USAGE.get(uid, 0)
-    last_purchase = "هیچ خریدی ثبت نشده است."
-    if uid in USER_RECENT_PURCHASES and USER_RECENT_PURCHASES[uid]:
-        last_purchase = USER_RECENT_PURCHASES[uid][-1][1]
-    last_gift = USER_LAST_GIFT_CODE.get(uid, "ندارد")
+    gift_usage, last_gift = await get_gift_usage(uid)
+    last_purchase = await get_last_purchase(uid) or "هیچ خریدی ثبت نشده است."
+    last_gift = last_gift or "ندارد"
     message = (
         f"🆔آیدی عددی کاربر : `{uid}`\n"
         f"➖➖➖➖➖\n"
@@ -1465,8 +3305,12 @@ async def search_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_send_users_txt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    total_users = len(REGISTERED_USERS)
-    total_balance = sum(USER_BALANCES.get(uid, 0) for uid in REGISTERED_USERS)
+    try:
+        total_users, total_balance = await get_users_txt()
+    except Exception as e:
+        logger.error(f"Error exporting {USERS_TXT_PATH}: {e}")
+        await query.edit_message_text(f"خطا در ساخت فایل user.txt: {e}", reply_markup=get_admin_panel_keyboard())
+        return
     description = (
         "🗂فایل txt اطلاعات کاربران\n"
         "➖➖➖➖➖➖➖\n"
@@ -1474,15 +3318,12 @@ async def admin_send_users_txt(update: Update, context: ContextTypes.DEFAULT_TYP
         "➖➖➖➖➖➖➖\n"
         f"💰موجودی تمام کاربران ثبت شده در فایل: {total_balance}"
     )
-    if os.path.exists("user.txt"):
-        await context.bot.send_document(
-            chat_id=update.effective_user.id,
-            document=open("user.txt", "rb"),
-            caption=description,
-            parse_mode="Markdown"
-        )
-    else:
-        await query.edit_message_text("فایل user.txt یافت نشد!", reply_markup=get_admin_panel_keyboard())
+    await context.bot.send_document(
+        chat_id=update.effective_user.id,
+        document=open(USERS_TXT_PATH, "rb"),
+        caption=description,
+        parse_mode="Markdown"
+    )
 
 async def panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.from_user.id == ADMIN_ID:
@@ -1515,23 +3356,99 @@ async def admin_receive_service_name(update: Update, context: ContextTypes.DEFAU
          await update.message.reply_text("لطفاً نام سرویس معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
          return ADD_CODE_SERVICE
     context.user_data["service_name"] = service_name
-    await update.message.reply_text("لطفاً مسیر فایل را ارسال کنید:", reply_markup=get_admin_cancel_keyboard())
+    await update.message.reply_text("لطفاً مسیر فایل را ارسال کنید یا فایل کدها را آپلود کنید:",
+                                    reply_markup=get_admin_cancel_keyboard())
     return ADD_CODE_FILEPATH
 
+async def import_code_file(name: str, file_path: str, on_progress):
+    """Stream a code file (one code per line) into the product's codes, chunk by chunk, skipping codes
+    already stored under any product. Calls on_progress(lines_read, added, bytes_read, file_size) after
+    each chunk. Returns (lines_read, added, already_sold)."""
+    product_id = PRODUCT_IDS[name]
+    file_size = os.path.getsize(file_path)
+    lines_read = added = already_sold = bytes_read = 0
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        while True:
+            lines = await asyncio.to_thread(f.readlines, CODE_IMPORT_CHUNK_BYTES)
+            if not lines:
+                break
+            lines_read += len(lines)
+            bytes_read += sum(len(line.encode("utf-8")) for line in lines)
+            codes = [code for code in (line.strip() for line in lines) if code]
+            chunk_added, _, chunk_sold = await asyncio.to_thread(insert_product_codes, product_id, codes)
+            added += chunk_added
+            already_sold += chunk_sold
+            if name in PRODUCT_CODE_TOTALS:
+                PRODUCT_CODE_TOTALS[name] += chunk_added
+            await on_progress(lines_read, added, bytes_read, file_size)
+    if CODE_INDEX is not None and CODE_INDEX.count > CODE_INDEX.capacity:
+        await load_code_index()
+    return lines_read, added, already_sold
+
+async def ingest_code_file(update: Update, service_name: str, file_path: str) -> None:
+    progress_message = await update.message.reply_text(f"⏳ در حال بارگذاری کدهای {service_name} ...")
+    last_edit = time.monotonic()
+
+    async def report(lines_read, added, bytes_read, file_size):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < CODE_IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        percent = bytes_read * 100 // file_size if file_size else 100
+        try:
+            await progress_message.edit_text(
+                f"⏳ در حال بارگذاری کدهای {service_name}: {percent}%\n"
+                f"خطوط خوانده شده: {lines_read} - کدهای جدید: {added}"
+            )
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Could not update code import progress: {e}")
+
+    try:
+        lines_read, added, already_sold = await import_code_file(service_name, file_path, report)
+    except Exception as e:
+        logger.error(f"Error importing codes for {service_name} from {file_path}: {e}")
+        await update.message.reply_text(f"خطا در بارگذاری فایل کدها: {e}", reply_markup=get_admin_panel_keyboard())
+        return
+    await set_product_code_file(service_name, file_path)
+    available = await count_available_codes(service_name)
+    logger.info(f"Imported {added} new codes ({lines_read} lines) for service {service_name} from {file_path}")
+    await update.message.reply_text(
+        f"سرویس {service_name} با مسیر فایل {file_path} ثبت شد.\n"
+        f"کدهای جدید: {added} - تکراری: {lines_read - added} (فروش رفته: {already_sold})\n"
+        f"تعداد کدهای موجود: {available}",
+        reply_markup=get_admin_panel_keyboard()
+    )
+
 async def add_code_filepath_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     file_path = update.message.text.strip()
     service_name = context.user_data.get("service_name", "")
-    SERVICE_FILE_PATH[service_name] = file_path
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as f:
-            codes = [line.strip() for line in f if line.strip()]
-        SERVICE_CODES[service_name] = codes
-        logger.info(f"Loaded {len(codes)} codes for service {service_name} from {file_path}")
-    else:
-        SERVICE_CODES[service_name] = []
+    if service_name not in PRODUCT_IDS:
+        await update.message.reply_text(f"سرویس {service_name} یافت نشد. ابتدا دکمه آن را اضافه کنید.",
+                                        reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    if not os.path.isfile(file_path):
         logger.info(f"File not found: {file_path}")
-    await update.message.reply_text(f"سرویس {service_name} با مسیر فایل {file_path} ثبت شد. تعداد کدهای موجود: {len(SERVICE_CODES[service_name])}",
-                                    reply_markup=get_admin_panel_keyboard())
+        await update.message.reply_text(f"فایل {file_path} یافت نشد.", reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    await ingest_code_file(update, service_name, file_path)
+    return ConversationHandler.END
+
+async def add_code_document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    service_name = context.user_data.get("service_name", "")
+    if service_name not in PRODUCT_IDS:
+        await update.message.reply_text(f"سرویس {service_name} یافت نشد. ابتدا دکمه آن را اضافه کنید.",
+                                        reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    document = update.message.document
+    os.makedirs(CODE_UPLOAD_DIR, exist_ok=True)
+    file_path = os.path.join(CODE_UPLOAD_DIR, f"{PRODUCT_IDS[service_name]}_{document.file_unique_id}.txt")
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(file_path)
+    except telegram.error.TelegramError as e:
+        await update.message.reply_text(f"خطا در دریافت فایل: {e}", reply_markup=get_admin_panel_keyboard())
+        return ConversationHandler.END
+    await ingest_code_file(update, service_name, file_path)
     return ConversationHandler.END
 
 # =====================================================================
@@ -1546,18 +3463,14 @@ async def admin_rename_button_start(update: Update, context: ContextTypes.DEFAUL
     if not PRODUCT_PRICES:
         await query.edit_message_text("هیچ دکمه‌ای وجود ندارد.", reply_markup=get_admin_panel_keyboard())
         return ConversationHandler.END
-    keyboard = []
-    for product in PRODUCT_PRICES.keys():
-        keyboard.append([InlineKeyboardButton(product, callback_data=f"rename_{product}")])
-    keyboard.append([InlineKeyboardButton("انصراف❌", callback_data="admin_cancel")])
-    await query.edit_message_text("دکمه‌ای که میخواهید نامش را تغییر دهید انتخاب کنید:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("دکمه‌ای که میخواهید نامش را تغییر دهید انتخاب کنید:",
+                                  reply_markup=get_product_picker_keyboard("rename_", cancel=True))
     return RENAME_BUTTON_SELECT
 
 async def admin_rename_button_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    original_name = query.data.split("_", 1)[1]
-    context.user_data["original_button_name"] = original_name
+    context.user_data["original_button_name"] = callback_product_id(query.data)
     await query.edit_message_text("نام جدید دکمه را وارد کنید :", reply_markup=get_admin_cancel_keyboard())
     return RENAME_BUTTON_INPUT
 
@@ -1566,16 +3479,14 @@ async def admin_rename_button_input(update: Update, context: ContextTypes.DEFAUL
     if not new_name:
         await update.message.reply_text("لطفاً یک نام معتبر وارد کنید!", reply_markup=get_admin_cancel_keyboard())
         return RENAME_BUTTON_INPUT
-    original_name = context.user_data.get("original_button_name")
+    original_name = PRODUCT_NAMES.get(context.user_data.get("original_button_name"))
     if not original_name or original_name not in PRODUCT_PRICES:
         await update.message.reply_text("دکمه مورد نظر پیدا نشد.", reply_markup=get_admin_panel_keyboard())
         return ConversationHandler.END
-    price = PRODUCT_PRICES.pop(original_name)
-    PRODUCT_PRICES[new_name] = price
-    if original_name in SERVICE_CODES:
-        SERVICE_CODES[new_name] = SERVICE_CODES.pop(original_name)
-    if original_name in SERVICE_FILE_PATH:
-        SERVICE_FILE_PATH[new_name] = SERVICE_FILE_PATH.pop(original_name)
+    if new_name != original_name and new_name in PRODUCT_PRICES:
+        await update.message.reply_text("دکمه‌ای با این نام وجود دارد!", reply_markup=get_admin_cancel_keyboard())
+        return RENAME_BUTTON_INPUT
+    await rename_product(original_name, new_name)
     await update.message.reply_text(f"نام دکمه از '{original_name}' به '{new_name}' تغییر یافت.", reply_markup=get_admin_panel_keyboard())
     return ConversationHandler.END
 
@@ -1612,6 +3523,85 @@ async def card_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.edit_message_text("لطفاً به پیام پایین پاسخ دهید.")
     await context.bot.send_message(chat_id=user.id, text=message, reply_markup=reply_markup, parse_mode="Markdown")
 
+# =====================================================================
+# NEW: TRX Price Feed (cached quote kept fresh in the background)
+# =====================================================================
+class TrxPriceFeed:
+    """Keeps the latest TRX/IRT quote in memory. A background loop refreshes it every
+    refresh_interval; readers get the cached quote while it is younger than max_age (starting one
+    shared background fetch when it is overdue) and only wait for the network when it is older."""
+
+    def __init__(self, url: str, refresh_interval: float, max_age: float, timeout: float):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.timeout = timeout
+        self.price = None
+        self.updated_at = 0.0          # monotonic time of the last good quote
+        self.client = None
+        self.inflight = None
+        self.stats = {"fetches": 0, "errors": 0}
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(max_connections=4))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def age(self) -> float:
+        return time.monotonic() - self.updated_at
+
+    async def fetch(self) -> float:
+        self.stats["fetches"] += 1
+        response = await self.client.post(self.url, data={"srcCurrency": "trx", "dstCurrency": "irt"})
+        response.raise_for_status()
+        price = float(response.json()["stats"]["trx-irt"]["latest"])
+        if price <= 0:
+            raise ValueError(f"invalid TRX price {price}")
+        self.price = price
+        self.updated_at = time.monotonic()
+        return price
+
+    def start_refresh(self) -> asyncio.Future:
+        """Start fetching a new quote unless a fetch is already in flight; returns the shared fetch."""
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.fetch())
+            self.inflight.add_done_callback(self._clear_inflight)
+        return self.inflight
+
+    async def refresh(self) -> float:
+        """Fetch a new quote; concurrent callers share one request."""
+        return await asyncio.shield(self.start_refresh())
+
+    def _clear_inflight(self, task):
+        self.inflight = None
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    async def get_price(self):
+        """Current quote, or None when no quote younger than max_age is available."""
+        if self.price is not None and self.age() < self.max_age:
+            if self.age() >= self.refresh_interval:
+                self.start_refresh()
+            return self.price
+        try:
+            return await self.refresh()
+        except Exception as e:
+            logger.error(f"Error fetching TRX price: {e}")
+        return None
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing TRX price: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+TRX_PRICE_FEED = TrxPriceFeed(TRX_PRICE_URL, TRX_PRICE_REFRESH_INTERVAL, TRX_PRICE_MAX_AGE, TRX_PRICE_TIMEOUT)
+
 async def crypto_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -1628,14 +3618,8 @@ async def trx_fixed_amount_handler(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
     data = query.data
     fixed_amount = int(data.split("_")[1])
-    try:
-        url = 'https://api.nobitex.ir/market/stats'
-        payload = {'srcCurrency': 'trx', 'dstCurrency': 'irt'}
-        response = requests.post(url, data=payload)
-        response.raise_for_status()
-        data_api = response.json()
-        price = float(data_api['stats']['trx-irt']['latest'])
-    except Exception as e:
+    price = await TRX_PRICE_FEED.get_price()
+    if price is None:
         await query.edit_message_text("❌ خطا در دریافت قیمت ترون. لطفاً بعداً امتحان کنید.", parse_mode="Markdown", reply_markup=get_inline_main_menu())
         return ConversationHandler.END
     rial_amount = fixed_amount * 10
@@ -1667,14 +3651,8 @@ async def trx_custom_amount_handler(update: Update, context: ContextTypes.DEFAUL
     if not (15000 <= custom_amount <= 1000000):
         await update.message.reply_text("کاربر عزیز مبلغ شما باید عددی بین 15000 تا 1000000 باشد🔴")
         return TRX_CUSTOM_INPUT
-    try:
-        url = 'https://api.nobitex.ir/market/stats'
-        payload = {'srcCurrency': 'trx', 'dstCurrency': 'irt'}
-        response = requests.post(url, data=payload)
-        response.raise_for_status()
-        data_api = response.json()
-        price = float(data_api['stats']['trx-irt']['latest'])
-    except Exception as e:
+    price = await TRX_PRICE_FEED.get_price()
+    if price is None:
         await update.message.reply_text("❌ خطا در دریافت قیمت ترون. لطفاً بعداً امتحان کنید.", parse_mode="Markdown", reply_markup=get_inline_main_menu())
         return ConversationHandler.END
     rial_amount = custom_amount * 10
@@ -1709,311 +3687,187 @@ async def admin_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data.clear()
     return ConversationHandler.END
 
+# =====================================================================
+# NEW: Callback Router and Handler Registration
+# =====================================================================
+# Callback data -> entry handler of the admin conversation
+ADMIN_CONVERSATION_ENTRIES = {
+    "admin_add_code": admin_add_code_entry,
+    "admin_add_credit": admin_add_credit_start,
+    "admin_subtract_credit": admin_subtract_credit_start,
+    "admin_unblock": admin_unblock_start,
+    "admin_ban": admin_ban_start,
+    "admin_message": admin_message_start,
+    "admin_balance": admin_balance_start,
+    "admin_recent_purchases": admin_recent_purchases_start,
+    "admin_broadcast": admin_broadcast_start,
+    "admin_forward": admin_forward_start,
+    "admin_increase_price": admin_increase_start,
+    "admin_decrease_price": admin_decrease_start,
+    "admin_delete_code": admin_delete_code_start,
+    "admin_create_gift": admin_create_gift_start,
+    "search_user_button": search_user_start,
+    "admin_add_button": admin_add_button_start,
+    "admin_remove_button": admin_remove_button_start,
+    "admin_rename_button": admin_rename_button_start,
+}
+
+# Callback data -> handler, for callbacks that no conversation reacts to
+# (admin_cancel is left to the conversations' fallbacks)
+CALLBACK_ROUTES = {
+    "menu_main": main_menu_handler,
+    "profile_charge": profile_charge_callback,
+    "check_membership": membership_check_callback,
+    "confirm_membership": confirm_membership_callback,
+    "admin_users_txt": admin_send_users_txt,
+    "admin_phone_file": admin_send_phone_file_handler,
+    "admin_turn_on_bot": admin_turn_on_bot,
+    "admin_turn_off_bot": admin_turn_off_bot,
+    "admin_stats": admin_stats_panel_handler,
+    "stats_products": stats_products_handler,
+    "stats_users": stats_users_handler,
+    "stats_overall": stats_overall_handler,
+    "admin_backup_db": admin_backup_db_handler,
+    "card_payment": card_payment_handler,
+    "crypto_payment": crypto_payment_handler,
+}
+
+# Prefix of "<prefix>_<argument>" callback data -> handler
+CALLBACK_PREFIX_ROUTES = {
+    "buy": buy_callback,
+    "charge": charge_callback,
+    "stats_product": stats_product_details_handler,
+    "sales_stats": sales_stats_handler,
+    "admin_banned_list": admin_banned_list_handler,
+}
+
+def find_callback_route(data):
+    """Handler for the callback data: exact match first, then its prefix; two dict lookups at most."""
+    if not isinstance(data, str):
+        return None
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is None:
+        handler = CALLBACK_PREFIX_ROUTES.get(data.rpartition("_")[0])
+    return handler
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await find_callback_route(update.callback_query.data)(update, context)
+
+async def admin_conversation_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await ADMIN_CONVERSATION_ENTRIES[update.callback_query.data](update, context)
+
+def build_handlers():
+    """All handlers in dispatch order. The callback router goes first: none of its callback data
+    is an entry point, state or fallback of a conversation, so most callbacks are matched by the
+    first handler checked."""
+    text_input = filters.TEXT & ~filters.COMMAND
+    cancel_fallbacks = [
+        CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
+        CommandHandler("cancel", admin_cancel_handler)
+    ]
+    gift_code_conv = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex("^🎁کد هدیه🎁$"), gift_code_handler)],
+        states={
+            GIFT_CODE_INPUT: [MessageHandler(text_input, gift_code_redeem_handler)]
+        },
+        fallbacks=cancel_fallbacks
+    )
+    # One state machine for every admin flow; tapping another admin button restarts it in that flow
+    admin_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_conversation_entry, pattern=ADMIN_CONVERSATION_ENTRIES.__contains__)],
+        states={
+            ADD_CODE_SERVICE: [MessageHandler(text_input, admin_receive_service_name)],
+            ADD_CODE_FILEPATH: [
+                MessageHandler(text_input, add_code_filepath_handler),
+                MessageHandler(filters.Document.ALL, add_code_document_handler)
+            ],
+            ADMIN_ADD_AMOUNT: [MessageHandler(text_input, admin_add_credit_amount)],
+            ADMIN_ADD_USERID: [MessageHandler(text_input, admin_add_credit_userid)],
+            ADMIN_SUB_AMOUNT: [MessageHandler(text_input, admin_subtract_credit_amount)],
+            ADMIN_SUB_USERID: [MessageHandler(text_input, admin_subtract_credit_userid)],
+            ADMIN_UNBLOCK_USERID: [MessageHandler(text_input, admin_unblock_userid)],
+            ADMIN_BAN_USERID: [MessageHandler(text_input, admin_ban_userid)],
+            ADMIN_MESSAGE_USERID: [MessageHandler(text_input, admin_message_userid)],
+            ADMIN_MESSAGE_TEXT: [MessageHandler(text_input, admin_message_text)],
+            ADMIN_BALANCE_USERID: [MessageHandler(text_input, admin_balance_userid)],
+            ADMIN_RECENT_PURCHASES_USERID: [MessageHandler(text_input, admin_recent_purchases_userid)],
+            ADMIN_BROADCAST_MESSAGE: [MessageHandler(text_input, admin_broadcast_message)],
+            ADMIN_FORWARD_MESSAGE: [MessageHandler(filters.ALL & ~filters.COMMAND, admin_forward_message)],
+            INCREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_increase_select, pattern="^increase_")],
+            INCREASE_PRODUCT_INPUT: [MessageHandler(text_input, admin_increase_input)],
+            DECREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_decrease_select, pattern="^decrease_")],
+            DECREASE_PRODUCT_INPUT: [MessageHandler(text_input, admin_decrease_input)],
+            ADMIN_DELETE_CODE_SERVICE: [CallbackQueryHandler(admin_delete_code_select, pattern="^delete_")],
+            ADMIN_DELETE_CODE_INPUT: [MessageHandler(text_input, admin_delete_code_input)],
+            ADMIN_GIFT_CHOICE: [CallbackQueryHandler(admin_gift_choice_selection, pattern="^admin_gift_(manual|random|bulk)$")],
+            ADMIN_BULK_GIFT_COUNT: [MessageHandler(text_input, admin_bulk_gift_count)],
+            ADMIN_BULK_GIFT_AMOUNT: [MessageHandler(text_input, admin_bulk_gift_amount)],
+            ADMIN_CREATE_GIFT_AMOUNT: [MessageHandler(text_input, admin_create_gift_amount)],
+            ADMIN_CREATE_GIFT_USAGE: [MessageHandler(text_input, admin_create_gift_usage)],
+            RANDOM_WINNER_COUNT: [MessageHandler(text_input, admin_gift_random_winner_count)],
+            RANDOM_CREDIT_AMOUNT: [MessageHandler(text_input, admin_gift_random_amount_handler)],
+            SEARCH_USER_INPUT: [MessageHandler(text_input, search_user_input)],
+            ADD_BUTTON_NAME: [MessageHandler(text_input, admin_receive_button_name)],
+            ADD_BUTTON_PRICE: [MessageHandler(text_input, admin_receive_button_price)],
+            REMOVE_BUTTON_SELECT: [CallbackQueryHandler(admin_remove_button_select, pattern="^remove_")],
+            RENAME_BUTTON_SELECT: [CallbackQueryHandler(admin_rename_button_select, pattern="^rename_")],
+            RENAME_BUTTON_INPUT: [MessageHandler(text_input, admin_rename_button_input)]
+        },
+        fallbacks=cancel_fallbacks,
+        allow_reentry=True
+    )
+    # ===================== NEW FEATURE: TRX Payment Flow =====================
+    trx_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(trx_payment_handler, pattern="^trx_payment$")],
+        states={
+            TRX_PAYMENT_MENU: [
+                CallbackQueryHandler(trx_fixed_amount_handler, pattern="^trx_\\d+$"),
+                CallbackQueryHandler(trx_custom_amount_prompt, pattern="^trx_custom$")
+            ],
+            TRX_CUSTOM_INPUT: [MessageHandler(text_input, trx_custom_amount_handler)]
+        },
+        fallbacks=cancel_fallbacks
+    )
+    return [
+        # Callback queries outside the conversations, dispatched by dict lookup
+        CallbackQueryHandler(route_callback, pattern=find_callback_route),
+        # ---------------- User Handlers ----------------
+        CommandHandler("start", start),
+        MessageHandler(filters.Regex("^خرید محصول 🛍$"), buy_product),
+        MessageHandler(filters.Regex("^👤 حساب کاربری$"), user_profile),
+        MessageHandler(filters.Regex("^شارژ حساب 💳$"), charge_account),
+        MessageHandler(filters.Regex("^پشتیبانی 👨‍💻$"), support_handler),
+        MessageHandler(filters.Regex("^📣 کانال های ما$"), channel_handler),
+        MessageHandler(filters.CONTACT, contact_handler),
+        gift_code_conv,
+        # ---------------- Admin Panel Command ----------------
+        CommandHandler("panel", panel_handler),
+        admin_conv,
+        trx_conv,
+        # Cancel pressed while no conversation is active
+        CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
+    ]
+
 if __name__ == '__main__':
     async def main():
         init_db()
-        load_user_data()
-        load_registered_users()
+        replay_balance_ledger()
+        load_products()
+        migrate_recent_purchases()
         load_banned_users()  # بارگذاری کاربران مسدود ذخیره شده از دیتابیس
-        application = Application.builder().token("7648152793:AAFKcpf87FqEevQ0GPViokkt8N_j9FG5Uv4").build()
-        
-        # ---------------- User Handlers ----------------
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(MessageHandler(filters.Regex("^خرید محصول 🛍$"), buy_product))
-        application.add_handler(CallbackQueryHandler(buy_callback, pattern="^buy_"))
-        application.add_handler(MessageHandler(filters.Regex("^👤 حساب کاربری$"), user_profile))
-        application.add_handler(MessageHandler(filters.Regex("^شارژ حساب 💳$"), charge_account))
-        application.add_handler(MessageHandler(filters.Regex("^پشتیبانی 👨‍💻$"), support_handler))
-        application.add_handler(MessageHandler(filters.Regex("^📣 کانال های ما$"), channel_handler))
-        application.add_handler(MessageHandler(filters.CONTACT, contact_handler))
-        
-        gift_code_conv = ConversationHandler(
-            entry_points=[MessageHandler(filters.Regex("^🎁کد هدیه🎁$"), gift_code_handler)],
-            states={
-                GIFT_CODE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, gift_code_redeem_handler)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
+        load_inactive_users()
+        load_stats()
+        load_gift_codes()
+        application = (
+            Application.builder()
+            .token("7648152793:AAFKcpf87FqEevQ0GPViokkt8N_j9FG5Uv4")
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+            .build()
         )
-        application.add_handler(gift_code_conv)
-        
-        application.add_handler(CallbackQueryHandler(charge_callback, pattern="^charge_"))
-        application.add_handler(CallbackQueryHandler(main_menu_handler, pattern="^menu_main$"))
-        application.add_handler(CallbackQueryHandler(profile_charge_callback, pattern="^profile_charge$"))
-        application.add_handler(CallbackQueryHandler(membership_check_callback, pattern="^check_membership$"))
-        # Register new membership confirmation handler
-        application.add_handler(CallbackQueryHandler(confirm_membership_callback, pattern="^confirm_membership$"))
-        
-        # ---------------- Admin Panel Command ----------------
-        application.add_handler(CommandHandler("panel", panel_handler))
         
-        admin_add_code_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_add_code_entry, pattern="^admin_add_code$")],
-            states={
-                ADD_CODE_SERVICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_service_name)],
-                ADD_CODE_FILEPATH: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_code_filepath_handler)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_add_code_conv)
-        
-        admin_add_credit_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_add_credit_start, pattern="^admin_add_credit$")],
-            states={
-                ADMIN_ADD_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_credit_amount)],
-                ADMIN_ADD_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_credit_userid)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_add_credit_conv)
-        
-        admin_subtract_credit_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_subtract_credit_start, pattern="^admin_subtract_credit$")],
-            states={
-                ADMIN_SUB_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_subtract_credit_amount)],
-                ADMIN_SUB_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_subtract_credit_userid)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_subtract_credit_conv)
-        
-        admin_unblock_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_unblock_start, pattern="^admin_unblock$")],
-            states={
-                ADMIN_UNBLOCK_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_unblock_userid)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_unblock_conv)
-        
-        admin_ban_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_ban_start, pattern="^admin_ban$")],
-            states={
-                ADMIN_BAN_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_ban_userid)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_ban_conv)
-        
-        admin_message_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_message_start, pattern="^admin_message$")],
-            states={
-                ADMIN_MESSAGE_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_userid)],
-                ADMIN_MESSAGE_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_text)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_message_conv)
-        
-        admin_balance_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_balance_start, pattern="^admin_balance$")],
-            states={
-                ADMIN_BALANCE_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_balance_userid)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_balance_conv)
-        
-        admin_recent_purchases_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_recent_purchases_start, pattern="^admin_recent_purchases$")],
-            states={
-                ADMIN_RECENT_PURCHASES_USERID: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_recent_purchases_userid)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_recent_purchases_conv)
-        
-        admin_broadcast_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_broadcast_start, pattern="^admin_broadcast$")],
-            states={
-                ADMIN_BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_message)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_broadcast_conv)
-        
-        admin_forward_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_forward_start, pattern="^admin_forward$")],
-            states={
-                ADMIN_FORWARD_MESSAGE: [MessageHandler(filters.ALL & ~filters.COMMAND, admin_forward_message)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_forward_conv)
-        
-        admin_increase_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_increase_start, pattern="^admin_increase_price$")],
-            states={
-                INCREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_increase_select, pattern="^increase_")],
-                INCREASE_PRODUCT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_increase_input)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_increase_conv)
-        
-        admin_decrease_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_decrease_start, pattern="^admin_decrease_price$")],
-            states={
-                DECREASE_PRODUCT_SELECT: [CallbackQueryHandler(admin_decrease_select, pattern="^decrease_")],
-                DECREASE_PRODUCT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_decrease_input)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_decrease_conv)
-        
-        admin_delete_code_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_delete_code_start, pattern="^admin_delete_code$")],
-            states={
-                ADMIN_DELETE_CODE_SERVICE: [CallbackQueryHandler(admin_delete_code_select, pattern="^delete_")],
-                ADMIN_DELETE_CODE_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_delete_code_input)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_delete_code_conv)
-        
-        admin_create_gift_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_create_gift_start, pattern="^admin_create_gift$")],
-            states={
-                ADMIN_GIFT_CHOICE: [CallbackQueryHandler(admin_gift_choice_selection, pattern="^admin_gift_(manual|random)$")],
-                ADMIN_CREATE_GIFT_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_create_gift_amount)],
-                ADMIN_CREATE_GIFT_USAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_create_gift_usage)],
-                RANDOM_WINNER_COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_gift_random_winner_count)],
-                RANDOM_CREDIT_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_gift_random_amount_handler)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_create_gift_conv)
-        
-        search_user_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(search_user_start, pattern="^search_user_button$")],
-            states={
-                SEARCH_USER_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_user_input)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(search_user_conv)
-        
-        # ---------------- Conversation Handlers for Button Management ----------------
-        admin_add_button_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_add_button_start, pattern="^admin_add_button$")],
-            states={
-                ADD_BUTTON_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_button_name)],
-                ADD_BUTTON_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_button_price)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_add_button_conv)
-        
-        admin_remove_button_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_remove_button_start, pattern="^admin_remove_button$")],
-            states={
-                REMOVE_BUTTON_SELECT: [CallbackQueryHandler(admin_remove_button_select, pattern="^remove_")]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_remove_button_conv)
-        
-        admin_rename_button_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(admin_rename_button_start, pattern="^admin_rename_button$")],
-            states={
-                RENAME_BUTTON_SELECT: [CallbackQueryHandler(admin_rename_button_select, pattern="^rename_")],
-                RENAME_BUTTON_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_rename_button_input)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(admin_rename_button_conv)
-        
-        application.add_handler(CallbackQueryHandler(admin_send_users_txt, pattern="^admin_users_txt$"))
-        application.add_handler(CallbackQueryHandler(admin_send_phone_file_handler, pattern="^admin_phone_file$"))
-        application.add_handler(CallbackQueryHandler(admin_turn_on_bot, pattern="^admin_turn_on_bot$"))
-        application.add_handler(CallbackQueryHandler(admin_turn_off_bot, pattern="^admin_turn_off_bot$"))
-        application.add_handler(CallbackQueryHandler(admin_stats_panel_handler, pattern="^admin_stats$"))
-        application.add_handler(CallbackQueryHandler(stats_products_handler, pattern="^stats_products$"))
-        application.add_handler(CallbackQueryHandler(stats_product_details_handler, pattern="^stats_product_"))
-        application.add_handler(CallbackQueryHandler(sales_stats_handler, pattern="^sales_stats_"))
-        application.add_handler(CallbackQueryHandler(stats_users_handler, pattern="^stats_users$"))
-        application.add_handler(CallbackQueryHandler(stats_overall_handler, pattern="^stats_overall$"))
-        application.add_handler(CallbackQueryHandler(admin_backup_db_handler, pattern="^admin_backup_db$"))
-        # NEW: Handler for banned users list
-        application.add_handler(CallbackQueryHandler(admin_banned_list_handler, pattern="^admin_banned_list_"))
-        
-        application.add_handler(CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"))
-        
-        # ===================== NEW FEATURE: TRX Payment Flow =====================
-        application.add_handler(CallbackQueryHandler(card_payment_handler, pattern="^card_payment$"))
-        application.add_handler(CallbackQueryHandler(crypto_payment_handler, pattern="^crypto_payment$"))
-        
-        trx_conv = ConversationHandler(
-            entry_points=[CallbackQueryHandler(trx_payment_handler, pattern="^trx_payment$")],
-            states={
-                TRX_PAYMENT_MENU: [
-                    CallbackQueryHandler(trx_fixed_amount_handler, pattern="^trx_\\d+$"),
-                    CallbackQueryHandler(trx_custom_amount_prompt, pattern="^trx_custom$")
-                ],
-                TRX_CUSTOM_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, trx_custom_amount_handler)]
-            },
-            fallbacks=[
-                CallbackQueryHandler(admin_cancel_handler, pattern="^admin_cancel$"),
-                CommandHandler("cancel", admin_cancel_handler)
-            ]
-        )
-        application.add_handler(trx_conv)
+        application.add_handlers(build_handlers())
         
         await application.run_polling()
     asyncio.run(main())
\ No newline at end of file